@@ -0,0 +1,483 @@
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+from functools import reduce
+from function import *
+from function import _postorder
+
+
+def bench_compile(number=10000):
+    f = create_function(lambda x, y: (x ** 2 + cos(x * y)) ** 0.5 * sin(x) / ln(y + 3) + x ** 5)
+    g = f.derivative(['x', 'x'])
+    compiled = g.compile(['x', 'y'])
+    called = timeit.timeit(lambda: g(x=1.3, y=0.7), number=number)
+    compiled_time = timeit.timeit(lambda: compiled(1.3, 0.7), number=number)
+    print('compile: %d evaluations of a %d-line derivative' % (number, compiled.source.count('\n')))
+    print('  __call__  %.4fs' % called)
+    print('  compiled  %.4fs  (x%.1f)' % (compiled_time, called / compiled_time))
+
+
+def bench_evaluate_array(size=100000):
+    import numpy
+    f = create_function(lambda x, y: (x ** 2 + cos(x * y)) ** 0.5 * sin(x) / ln(y + 3) + x ** 5)
+    g = f.derivative('x')
+    xs, ys = numpy.linspace(0.1, 2, size), numpy.linspace(0.5, 1, size)
+    out = numpy.empty(size)
+    compiled = g.compile(['x', 'y'])
+    looped = timeit.timeit(lambda: [compiled(a, b) for a, b in zip(xs.tolist(), ys.tolist())], number=1)
+    vectorized = timeit.timeit(lambda: g.evaluate_array(out=out, x=xs, y=ys), number=1)
+    print('evaluate_array: derivative at %d points' % size)
+    print('  compiled loop   %.4fs' % looped)
+    print('  evaluate_array  %.4fs  (x%.1f)' % (vectorized, looped / vectorized))
+
+
+def bench_gradient(size=50):
+    xs = [var('x%d' % i) for i in range(size)]
+    loss = reduce(lambda a, b: a + b, [(xs[i] - xs[i - 1] ** 2) ** 2 + sin(xs[i] * xs[i - 1]) for i in range(1, size)])
+    names = [i.var for i in xs]
+    point = dict((name, 0.5) for name in names)
+    symbolic = timeit.timeit(lambda: [loss.derivative(i) for i in names], number=1)
+    reverse = timeit.timeit(lambda: loss.gradient(names), number=1)
+    numeric = timeit.timeit(lambda: loss.value_and_grad(point), number=1)
+    print('gradient: %d variables' % size)
+    print('  derivative per var  %.4fs' % symbolic)
+    print('  gradient            %.4fs  (x%.1f)' % (reverse, symbolic / reverse))
+    print('  value_and_grad      %.4fs  (x%.1f)' % (numeric, symbolic / numeric))
+
+
+def bench_derivative_cache(order=5):
+    f = create_function(lambda x, y: (x ** 2 + cos(x * y)) ** 0.5 * sin(x) / ln(y + 3))
+    maxsize = derivative_cache.maxsize
+    print('derivative cache: derivative of order %d' % order)
+    for size in (0, maxsize):
+        derivative_cache.clear()
+        derivative_cache.maxsize = size
+        seconds = timeit.timeit(lambda: f.derivative(['x'] * order), number=1)
+        print('  maxsize=%-7d %.4fs  %r' % (size, seconds, derivative_cache.stats()))
+    derivative_cache.maxsize = maxsize
+
+
+def bench_antiderivative(size=200):
+    x, y = var('x'), var('y')
+    coef = reduce(lambda a, b: a + b, [sin(y * i) for i in range(1, size)])
+    f = reduce(lambda a, b: a + b, [coef * i * x ** i for i in range(size)])
+    seconds = timeit.timeit(lambda: f.antiderivative(x), number=1)
+    print('antiderivative: sum of %d terms sharing a %d-term coefficient  %.4fs' % (size, size, seconds))
+    for terms in (1000, 5000):
+        polynomial = reduce(lambda a, b: a + b, [i * x ** i - x / (i + 1) for i in range(1, terms)])
+        trig = reduce(lambda a, b: a + b, [cos(x * i + y) * i - sin(2 * x - i) for i in range(1, terms)])
+        for name, g in (('polynomial', polynomial), ('trig', trig)):
+            antiderivative_cache.clear()
+            start = time.time()
+            g.antiderivative(x)
+            cold = time.time() - start
+            start = time.time()
+            g.antiderivative(x)
+            print('  %-10s sum of %d terms: %.4fs, memoized %.6fs' % (name, terms, cold, time.time() - start))
+
+
+def bench_memory(size=2000):
+    x, y = var('x'), var('y')
+    f = reduce(lambda a, b: a + b, [sin(x * i + y) * x ** i for i in range(1, size)])
+    g = f.derivative('x')
+    nodes = set(id(i) for i in _postorder(g))
+    objects = sum(sys.getsizeof(i) + (sys.getsizeof(i.__dict__) if hasattr(i, '__dict__') else 0) for i in _postorder(g))
+    table = sum(sys.getsizeof(key) + sys.getsizeof(ref) for key, ref in Function._interned.data.items() if id(ref()) in nodes)
+    tape = g.freeze()
+    print('memory: %d distinct nodes, bytes per node' % len(nodes))
+    print('  node objects    %.1f' % (objects * 1.0 / len(nodes)))
+    print('  interning table %.1f' % (table * 1.0 / len(nodes)))
+    print('  tape            %.1f  (+ %d consts, %d names)' % (tape.nbytes() * 1.0 / len(tape), len(tape.consts), len(tape.names)))
+
+
+def bench_plan(number=2000):
+    f = create_function(lambda x, y: (x ** 2 + cos(x * y)) ** 0.5 * sin(x) / ln(y + 3))
+    print('plan: nth derivative, shared subtrees and __call__ time for %d points' % number)
+    for n in range(1, 5):
+        g = f.derivative(['x'] * n)
+        plan = g.plan()
+        seconds = timeit.timeit(lambda: g(x=1.3, y=0.7), number=number)
+        print('  n=%d  %5d distinct of %7d tree nodes  %.4fs' % (n, len(plan.nodes), plan.tree_size, seconds))
+
+
+def bench_simplified_derivative(orders=(2, 4, 6)):
+    x = var('x')
+    functions = [x ** 2 * sin(x), (x ** 2 + cos(x)) ** 0.5, x ** 3 / (1 + x ** 2), sin(x) * cos(x) * ln(x)]
+    print('simplified derivative: tree nodes and time of nth derivative, plain / simplify=True')
+    for f in functions:
+        for n in orders:
+            row = []
+            for simplify in (False, True):
+                derivative_cache.clear()
+                simplified_derivative_cache.clear()
+                seconds = timeit.timeit(lambda: f.derivative(['x'] * n, simplify), number=1)
+                row += [f.derivative(['x'] * n, simplify).plan().tree_size, seconds]
+            print('  %-26r n=%d  %7d %.4fs / %7d %.4fs' % tuple([f, n] + row))
+
+
+def bench_simplified_width(sizes=(500, 1000, 2000, 4000)):
+    x, y = var('x'), var('y')
+    print('simplified derivative: d/dy of sums of n terms sin(x * i) * y, time per term should stay flat')
+    for n in sizes:
+        f = create_const(0)
+        for i in range(n):
+            f = f + sin(x * i) * y
+        derivative_cache.clear()
+        simplified_derivative_cache.clear()
+        seconds = timeit.timeit(lambda: f.derivative('y', simplify=True), number=1)
+        print('  n=%-5d %.4fs, %.1fus per term' % (n, seconds, seconds / n * 1e6))
+
+
+def bench_evaluate_many(size=200000):
+    import random
+    f = create_function(lambda x, y: (x ** 2 + cos(x * y)) ** 0.5 * sin(x) / ln(y + 3))
+    g = f.derivative(['x', 'x'])
+    points = [(random.random(), random.random()) for i in range(size)]
+    print('evaluate_many: %d points of a %d-node derivative, %d cpus' % (size, len(g.plan().nodes), multiprocessing.cpu_count()))
+    single = None
+    for workers in (1, 2, 4, 8):
+        seconds = timeit.timeit(lambda: g.evaluate_many(points, workers), number=1)
+        single = single or seconds
+        print('  workers=%d  %.4fs  (x%.2f)' % (workers, seconds, single / seconds))
+
+
+def bench_evaluate_stream(size=200000, chunksize=5000):
+    f = create_function(lambda x, y: (x ** 2 + cos(x * y)) ** 0.5 * sin(x) / ln(y + 3))
+    g = f.derivative(['x', 'x'])
+    stream = lambda: ((i % 1000 * 0.001, 0.5) for i in range(size))
+    print('evaluate_stream: %d generated points, chunks of %d' % (size, chunksize))
+    for vectorized in (False, True):
+        seconds = timeit.timeit(lambda: sum(g.evaluate_stream(stream(), chunksize=chunksize, vectorized=vectorized)), number=1)
+        print('  vectorized=%-5s %.4fs' % (vectorized, seconds))
+
+
+def bench_subs(number=20000):
+    f = create_function(lambda x, y, z: (x ** 2 + cos(y * z)) ** 0.5 * sin(x * y) / ln(z + y ** 2))
+    g = f.derivative(['x', 'y'])
+    specialized = g.subs(y=0.5, z=2)
+    print('subs: y, z fixed in a %d node derivative -> %d nodes' % (g.size(), specialized.size()))
+    for name, h, point in (('full', g, {'x': 0.3, 'y': 0.5, 'z': 2}), ('specialized', specialized, {'x': 0.3})):
+        compiled = h.compile(sorted(point))
+        args = [point[i] for i in sorted(point)]
+        seconds = timeit.timeit(lambda: compiled(*args), number=number)
+        print('  %-11s %d calls %.4fs' % (name, number, seconds))
+
+
+def bench_forward(number=200):
+    f = create_function(lambda x, y: (x ** 2 + cos(x * y)) ** 0.5 * sin(x) / ln(y + 3))
+    point = {'x': 0.3, 'y': 0.5}
+    print('forward: numeric partials at a point, %d repeats' % number)
+
+    def symbolic():
+        derivative_cache.clear()
+        return [f.derivative(i)(**point) for i in 'xy']
+
+    for name, run in (('symbolic', symbolic),
+                      ('forward x', lambda: f.forward(point, {'x': 1})),
+                      ('forward x,y', lambda: f.forward(point, {'x': [1, 0], 'y': [0, 1]}))):
+        seconds = timeit.timeit(run, number=number)
+        print('  %-11s %.4fs' % (name, seconds))
+
+
+def bench_taylor(orders=(2, 4, 6, 8)):
+    f = create_function(lambda x, y: (x ** 2 + cos(x * y)) ** 0.5 * sin(x) / ln(y + 3))
+    point = {'x': 0.3, 'y': 0.5}
+    print('taylor: coefficients up to order k, taylor vs repeated symbolic derivative')
+    for order in orders:
+        derivative_cache.clear()
+        start = time.time()
+        symbolic = [f.derivative(['x'] * k)(**point) if k else f(**point) for k in range(order + 1)]
+        symbolic_seconds = time.time() - start
+        start = time.time()
+        f.taylor('x', point['x'], order, point)
+        print('  k=%d symbolic %.4fs (%d nodes) taylor %.4fs' % (
+            order, symbolic_seconds, f.derivative(['x'] * order).size(), time.time() - start))
+
+
+def bench_jacobian(size=60, number=200):
+    xs = [var('x%d' % i) for i in range(size)]
+    functions = [sin(xs[i] * xs[i - 1]) + xs[i] ** 2 / (1 + xs[(i + 7) % size] ** 2) for i in range(size)]
+    names = [i.var for i in xs]
+    point = [0.1 * i for i in range(size)]
+    print('jacobian: %d outputs of %d vars, 3 vars each' % (size, size))
+    derivative_cache.clear()
+    start = time.time()
+    dense = [[f.derivative(v).compile(names) for v in names] for f in functions]
+    built = time.time() - start
+    seconds = timeit.timeit(lambda: [[entry(*point) for entry in row] for row in dense], number=number)
+    print('  dense per entry   build %.4fs, %d evaluations %.4fs' % (built, number, seconds))
+    derivative_cache.clear()
+    start = time.time()
+    compiled = jacobian(functions, names).compile()
+    built = time.time() - start
+    seconds = timeit.timeit(lambda: compiled(*point), number=number)
+    print('  sparse compiled   build %.4fs, %d evaluations %.4fs (%d nonzero)' % (
+        built, number, seconds, len(compiled(*point)[2])))
+
+
+def bench_simplify(sizes=(1000, 2000, 4000)):
+    x, y = var('x'), var('y')
+    print('simplify: sums and products of n terms')
+    for n in sizes:
+        f, g = create_const(0), create_const(1)
+        for i in range(n):
+            f = f + (i % 7 + 1) * sin(x * (i % (n // 2))) * y / x - 3
+            g = g * x ** (i % 5) / cos(y + i % (n // 2))
+        start = time.time()
+        f.simplify_sum()
+        middle = time.time()
+        g.simplify_mult()
+        print('  n=%-5d simplify_sum %.4fs simplify_mult %.4fs' % (n, middle - start, time.time() - middle))
+
+
+def bench_disk_cache(order=4):
+    functions = [create_function(lambda x, y: (x ** 2 + cos(x * y)) ** 0.5 * sin(x) / ln(y + 3)),
+                 create_function(lambda x, y: x ** 3 / (1 + x ** 2) + log(y, 7 / x)),
+                 create_function(lambda x, y: sin(x) ** 3 * cos(y) ** 2 / (x + y) ** 0.5)]
+    directory = tempfile.mkdtemp()
+    print('disk cache: simplified derivatives of order %d and compiled code of %d functions' % (order, len(functions)))
+    try:
+        for start in ('cold', 'warm'):
+            derivative_cache.clear()
+            simplified_derivative_cache.clear()
+            cache = DiskCache(directory)
+            began = time.time()
+            for f in functions:
+                cache.compile(cache.derivative(f, ['x'] * order, simplify=True), ['x', 'y'])
+            print('  %s %.4fs, %d bytes on disk' % (start, time.time() - began, cache.stats()['bytes']))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_repr(sizes=(10000, 40000)):
+    x, y = var('x'), var('y')
+    print('repr: sums of n terms sin(x * i) * y')
+    for n in sizes:
+        f = create_const(0)
+        for i in range(n):
+            f = f + sin(x * i) * y
+        with open(os.devnull, 'w') as stream:
+            start = time.time()
+            f.render(stream)
+            streamed = time.time() - start
+        start = time.time()
+        length = len(repr(f))
+        first = time.time() - start
+        start = time.time()
+        repr(f)
+        print('  n=%-6d %d chars: render %.4fs, repr %.4fs, again %.6fs' % (n, length, streamed, first, time.time() - start))
+
+
+def bench_integrate(intervals=200):
+    f = create_function(lambda x, y: sin(x * y) * ln(x + 1) / (1 + x ** 2))
+    ranges = [(0, 0.05 * i) for i in range(1, intervals + 1)]
+    print('integrate: %d intervals of a function without antiderivative' % intervals)
+    start = time.time()
+    for a, b in ranges:
+        f.integrate('x', a, b, {'y': 1.5})
+    print('  one by one %.4fs' % (time.time() - start))
+    start = time.time()
+    f.integrate_many(ranges, 'x', {'y': 1.5})
+    print('  batched    %.4fs' % (time.time() - start))
+
+
+def bench_lazy_derivative(size=2000):
+    x, y = var('x'), var('y')
+    f = reduce(lambda a, b: a + b, [sin(x * i) * x ** i + cos(x / i) for i in range(1, size)]) + sin(x * y) * y
+    point = {'x': 0.3, 'y': 0.5}
+    print('lazy derivative: d/dy d/dx of a %d term sum with one y term, evaluated once' % size)
+    for lazy in (False, True):
+        derivative_cache.clear()
+        start = time.time()
+        f.derivative('x', lazy=lazy).derivative('y', lazy=lazy)(**point)
+        print('  lazy=%-5s %.4fs' % (lazy, time.time() - start))
+
+
+def bench_function_bank(size=200, number=200):
+    x, y = var('x'), var('y')
+    shared = sin(x * y) + cos(x) ** 2 / (1 + y ** 2)
+    functions = [shared * i + ln(x + i) * shared ** 2 for i in range(1, size)]
+    functions += [f.derivative('x') for f in functions[:size // 4]]
+    bank = FunctionBank(functions)
+    point = {'x': 0.3, 'y': 0.5}
+    print('function bank: %d functions sharing subexpressions, %r' % (len(bank), bank.stats()))
+    compiled = [f.compile(['x', 'y']) for f in functions]
+    together = bank.compile(['x', 'y'])
+    for name, run in (('separate __call__', lambda: [f(**point) for f in functions]),
+                      ('bank __call__', lambda: bank(**point)),
+                      ('separate compiled', lambda: [f(0.3, 0.5) for f in compiled]),
+                      ('bank compiled', lambda: together(0.3, 0.5))):
+        print('  %-17s %d points %.4fs' % (name, number, timeit.timeit(run, number=number)))
+
+
+def _polynomial(n):
+    x = var('x')
+    return reduce(lambda a, b: a + b, [(i + 1) * x ** i for i in range(n + 1)])
+
+
+def _trig_chain(n):
+    f = var('x')
+    for i in range(n):
+        f = (sin(f), cos(f), ln(f + 2))[i % 3]
+    return f
+
+
+def _wide_sum(n):
+    xs = [var('x%d' % i) for i in range(n)]
+    return reduce(lambda a, b: a + b, [sin(xs[i]) * xs[i - 1] for i in range(n)])
+
+
+def _deep_product(n):
+    x = var('x')
+    return reduce(lambda a, b: a * b, [x + i for i in range(1, n + 1)])
+
+
+FAMILIES = [
+    ('polynomial', _polynomial, (10, 50, 200)),
+    ('trig_chain', _trig_chain, (5, 20, 80)),
+    ('wide_sum', _wide_sum, (10, 100, 1000)),
+    ('deep_product', _deep_product, (10, 50, 200)),
+]
+
+OPERATIONS = [
+    ('derivative', lambda f, point: f.derivative(min(point))),
+    ('call', lambda f, point: f(**point)),
+    ('simplify_sum', lambda f, point: f.simplify_sum()),
+    ('repr', lambda f, point: repr(f)),
+]
+
+
+def _measure(build, n, operation):
+    'Time, node counts and peak memory growth (kB) of operation on a freshly built expression'
+    f = build(n)
+    point = dict((i.var, 0.5) for i in _postorder(f) if isinstance(i, Fvar))
+    derivative_cache.clear()
+    simplified_derivative_cache.clear()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    result = operation(f, point)
+    seconds = time.time() - start
+    return {
+        'seconds': seconds,
+        'nodes': len(_postorder(f)),
+        'result_nodes': len(_postorder(result)) if isinstance(result, Function) else None,
+        'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak,
+    }
+
+
+def _measure_isolated(build, n, operation):
+    'Runs _measure in a forked child, so that interning, caches and peak memory start cold'
+    if not hasattr(os, 'fork'):
+        return _measure(build, n, operation)
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            os.write(write, json.dumps(_measure(build, n, operation)).encode())
+        finally:
+            os._exit(0)
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return json.loads(b''.join(chunks).decode())
+
+
+def run_suite(repeat=5):
+    'Best of repeat runs for every family, size and operation, keyed "family/size/operation"'
+    results = {}
+    for family, build, sizes in FAMILIES:
+        for n in sizes:
+            for name, operation in OPERATIONS:
+                runs = [_measure_isolated(build, n, operation) for i in range(repeat)]
+                best = min(runs, key=lambda i: i['seconds'])
+                best['peak_kb'] = min(i['peak_kb'] for i in runs)
+                results['%s/%d/%s' % (family, n, name)] = best
+    return results
+
+
+def print_suite(results):
+    print('%-32s %10s %8s %8s %9s' % ('family/size/operation', 'seconds', 'nodes', 'result', 'peak kB'))
+    for key in sorted(results, key=lambda i: (i.split('/')[0], int(i.split('/')[1]), i.split('/')[2])):
+        r = results[key]
+        print('%-32s %10.5f %8d %8s %9d' % (key, r['seconds'], r['nodes'], r['result_nodes'] or '-', r['peak_kb']))
+
+
+def compare_suite(results, baseline, threshold=2.0, noise=0.005):
+    'Keys whose time or peak memory grew beyond threshold times the baseline (ignoring tiny absolute changes)'
+    regressions = []
+    for key in sorted(set(results) & set(baseline)):
+        new, old = results[key], baseline[key]
+        if new['seconds'] > old['seconds'] * threshold and new['seconds'] - old['seconds'] > noise:
+            regressions.append('%s: %.5fs -> %.5fs' % (key, old['seconds'], new['seconds']))
+        if new['peak_kb'] > old['peak_kb'] * threshold and new['peak_kb'] - old['peak_kb'] > 1024:
+            regressions.append('%s: %d kB -> %d kB' % (key, old['peak_kb'], new['peak_kb']))
+    return regressions
+
+
+def bench_features():
+    bench_compile()
+    bench_evaluate_array()
+    bench_gradient()
+    bench_derivative_cache()
+    bench_antiderivative()
+    bench_memory()
+    bench_plan()
+    bench_simplified_derivative()
+    bench_simplified_width()
+    bench_evaluate_many()
+    bench_evaluate_stream()
+    bench_subs()
+    bench_forward()
+    bench_taylor()
+    bench_jacobian()
+    bench_simplify()
+    bench_disk_cache()
+    bench_repr()
+    bench_integrate()
+    bench_lazy_derivative()
+    bench_function_bank()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks of the function module')
+    parser.add_argument('command', nargs='?', choices=('features', 'suite'), default='features',
+                        help='features: one benchmark per optimization; suite: expression families across sizes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', metavar='FILE', help='store suite results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='flag regressions against a stored baseline')
+    parser.add_argument('--threshold', type=float, default=2.0)
+    args = parser.parse_args(argv)
+    if args.command == 'features':
+        bench_features()
+        return 0
+    results = run_suite(args.repeat)
+    print_suite(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_suite(results, json.load(f), args.threshold)
+        for i in regressions:
+            print('REGRESSION ' + i)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,3 +1,7 @@
 
 class CantFindAntiDerivativeException(Exception):
     pass
+
+
+class QuadratureLimitException(Exception):
+    pass
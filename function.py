@@ -1,23 +1,387 @@
+import hashlib
+import heapq
 import math
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+import weakref
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import reduce
+from itertools import islice
 import errors
 
 
-class Function:
+class Function(object):
+    'Nodes are interned: structurally identical nodes are the same object'
 
-    def derivative(self, var='x'):
+    __slots__ = ('_hash', '_free_vars', '_compiled', '_plan', '_repr', '_memo', '__weakref__')
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, *args):
+        key = (cls,) + tuple(id(i) if isinstance(i, Function) else (i.__class__, i) for i in args)
+        node = Function._interned.get(key)
+        if node is None:
+            node = object.__new__(cls)
+            node._hash = hash((cls.__name__,) + args)
+            Function._interned[key] = node
+        return node
+
+    def __reduce__(self):
+        return (self.__class__, self._children())
+
+    def derivative(self, var='x', simplify=False, lazy=False):
+        'With simplify, the derivative of every node is normalized as soon as it is built; lazy gives an Fderivative'
         if hasattr(var, '__iter__'):
-            return reduce(Function.derivative, [self] + var)
-        return self._der(self._check_or_create_var(var))
+            return reduce(lambda f, i: f.derivative(i, simplify, lazy), var, self)
+        var = self._check_or_create_var(var)
+        if lazy:
+            if simplify:
+                raise ValueError("lazy derivatives are not simplified")
+            if not self.depends_on(var):
+                return Fconst(0)
+            return derivative_cache.get(self, var) or Fderivative(self, var)
+        cache = simplified_derivative_cache if simplify else derivative_cache
+        derivatives = {}
+
+        def uncached(node):
+            result = cache.get(node, var)
+            if result is None:
+                return True
+            derivatives[id(node)] = result
+            return False
+
+        order = _postorder(self, uncached)
+        summands = set()
+        if simplify:
+            # Derivatives used only as terms of a sum's derivative are normalized with it, not on their own
+            others = set([id(self)])
+            for node in order:
+                if id(node) not in derivatives:
+                    parents = summands if node._summand_signs() is not None else others
+                    parents.update(id(i) for i in node._children())
+            summands -= others
+        for node in order:
+            if id(node) not in derivatives:
+                derivatives[id(node)] = node._der(var, [derivatives[id(i)] for i in node._children()])
+                if id(node) in summands:
+                    continue
+                if simplify:
+                    derivatives[id(node)] = derivatives[id(node)]._normalize()
+                cache.put(node, var, derivatives[id(node)])
+        return derivatives[id(self)]
+
+    def subs(self, **values):
+        'Replaces vars by numbers or functions, folding the subtrees left without vars into constants'
+        values = dict((i, self._check_for_num(values[i])) for i in values)
+        for i in values:
+            if values[i].__class__ == str:
+                values[i] = Fvar(values[i])
+        names = frozenset(values)
+
+        def touched(node):
+            return not node.free_vars() or node.free_vars() & names
+
+        def substitute(node, operands):
+            if node.__class__ == Fvar:
+                return values.get(node.var, node)
+            if not node._children() or not touched(node):
+                return node
+            node = node._rebuild(operands)
+            constants = [_const_value(i) for i in node._children()]
+            if node._children() and None not in constants:
+                return create_const(node._eval(constants))
+            return node
+
+        return _fold(self, substitute, touched)
 
     def antiderivative(self, var='x'):
+        'Rules of _antiderivative_rules, through sums and constant factors without recursion; memo in antiderivative_cache'
         var = self._check_or_create_var(var)
-        if not self.depends_on(var):
-            return self * var
-        return self._antider(var)
+        results = {}
+
+        shapes = {}
+
+        def expand(node):
+            'Also fills results from the memo; constant children are integrated by the rules that need them'
+            cached = antiderivative_cache.get(node, var)
+            if cached is not None:
+                results[id(node)] = cached
+                return False
+            if node.__class__ not in _linear_classes:
+                return False
+            shapes[id(node)] = node._shape(var)
+            return (node.__class__, shapes[id(node)]) in _linear_rules
+
+        for node in _postorder(self, expand):
+            if id(node) not in results and (node is self or node.depends_on(var)):
+                results[id(node)] = node._antider(var, [results.get(id(i)) for i in node._children()], shapes.get(id(node)))
+                antiderivative_cache.put(node, var, results[id(node)])
+        return results[id(self)]
 
     def depends_on(self, var):
-        return self._depends_on(self._check_or_create_var(var))
+        'Fderivative nodes are expanded only where the function they differentiate depends on var'
+        if var.__class__ == Fvar:
+            var = var.var
+        elif var.__class__ != str:
+            raise ValueError("var should be Fvar or string")
+        if getattr(self, '_free_vars', None) is None:
+            self._fill_free_vars(False)
+        stack, seen = [self], set([id(self)])
+        while stack:
+            node = stack.pop()
+            if getattr(node, '_free_vars', None) is not None:
+                if var in node._free_vars:
+                    return True
+                continue
+            if node.__class__ == Fderivative and not node.f.depends_on(var):
+                continue
+            for i in node._children():
+                if id(i) not in seen:
+                    seen.add(id(i))
+                    stack.append(i)
+        return False
+
+    def free_vars(self):
+        'Names of the variables the function depends on, computed once per node; expands Fderivative nodes'
+        if getattr(self, '_free_vars', None) is None:
+            self._fill_free_vars(True)
+        return self._free_vars
+
+    def _fill_free_vars(self, expand):
+        'Var sets of the nodes below, left unknown above Fderivative nodes unless expand'
+        for node in _postorder(self, lambda node: getattr(node, '_free_vars', None) is None and
+                               (expand or node.__class__ != Fderivative)):
+            if getattr(node, '_free_vars', None) is not None or node.__class__ == Fderivative and not expand:
+                continue
+            if node.__class__ == Fvar:
+                node._free_vars = frozenset([node.var])
+                continue
+            node._free_vars = _no_vars
+            for i in node._children():
+                if getattr(i, '_free_vars', None) is None:
+                    node._free_vars = None
+                    break
+                if not i._free_vars <= node._free_vars:
+                    node._free_vars = node._free_vars | i._free_vars
+
+    def compile(self, vars=None):
+        'Returns plain python function of positional args, ordered as vars (sorted names by default)'
+        if vars is not None:
+            vars = tuple(self._check_or_create_var(i).var for i in vars)
+        if getattr(self, '_compiled', None) is None:
+            self._compiled = {}
+        if vars not in self._compiled:
+            self._compiled[vars] = _compile(self, vars)
+        return self._compiled[vars]
+
+    def plan(self):
+        'Evaluation order of the distinct subtrees, computed once; see Plan'
+        if getattr(self, '_plan', None) is None:
+            self._plan = Plan(self)
+        return self._plan
+
+    def size(self):
+        'Number of nodes counting repeated subtrees, as if the expression were a tree'
+        return self.plan().tree_size
+
+    def depth(self):
+        return self.plan().depth
+
+    def node_counts(self):
+        'Number of distinct nodes per class name'
+        return dict(self.plan().class_counts)
+
+    def freeze(self):
+        'Compact flat form of the expression, see Tape'
+        return Tape(self)
+
+    def digest(self):
+        'Structural hash (sha1 hex) of the expression, the same in every process, unlike hash()'
+        return hashlib.sha1(repr(Tape(self).__getstate__())).hexdigest()
+
+    def gradient(self, vars):
+        'All partial derivatives in one reverse sweep, sharing subexpressions between them'
+        adjoints = {id(self): Fconst(1)}
+        for node in reversed(self.plan().nodes):
+            adjoint = adjoints.get(id(node))
+            if adjoint is None or not node._children():
+                continue
+            for child, partial in zip(node._children(), node._partials()):
+                if partial.is_zero():
+                    continue
+                if partial.__class__ == Funminus and partial.arg.is_one():
+                    term = -adjoint
+                else:
+                    term = adjoint * partial
+                adjoints[id(child)] = adjoints[id(child)] + term if id(child) in adjoints else term
+        return [adjoints.get(id(self._check_or_create_var(i)), Fconst(0)) for i in vars]
+
+    def value_and_grad(self, point, vars=None):
+        'Value at point (dict of var values) and numeric gradient ordered as vars (sorted names by default)'
+        nodes = self.plan().nodes
+        values = _node_values(nodes, point)
+        adjoints = {id(self): 1.0}
+        for node in reversed(nodes):
+            adjoint = adjoints.get(id(node))
+            children = node._children()
+            if adjoint is None or not children:
+                continue
+            local = node._local_grads([values[id(i)] for i in children], values[id(node)])
+            for child, partial in zip(children, local):
+                adjoints[id(child)] = adjoints.get(id(child), 0) + adjoint * partial
+        if vars is None:
+            vars = sorted(point)
+        return values[id(self)], [adjoints.get(id(self._check_or_create_var(i)), 0) for i in vars]
+
+    def forward(self, point, seeds):
+        'Value at point and derivative along seeds (var name -> number, or -> sequence for several directions at once)'
+        single = not any(isinstance(seeds[i], (list, tuple)) for i in seeds)
+        seeds = dict((i, [seeds[i]] if single else list(seeds[i])) for i in seeds)
+        width = len(next(iter(seeds.values()))) if seeds else 1
+        if any(len(seeds[i]) != width for i in seeds):
+            raise ValueError('Seeds of different lengths')
+        values, tangents = {}, {}
+        for node in self.plan().nodes:
+            if node.__class__ == Fvar:
+                values[id(node)] = point[node.var]
+                tangents[id(node)] = seeds.get(node.var)
+                continue
+            if node.__class__ == Fconst:
+                values[id(node)] = node.c
+                continue
+            children = node._children()
+            operands = [values[id(i)] for i in children]
+            value = values[id(node)] = node._eval(operands)
+            inner = [(i, tangents.get(id(j))) for i, j in enumerate(children)]
+            inner = [i for i in inner if i[1] is not None]
+            if not inner:
+                continue
+            local = node._local_grads(operands, value)
+            tangent = [0.0] * width
+            for i, child in inner:
+                for j in range(width):
+                    if child[j]:
+                        tangent[j] += local[i] * child[j]
+            tangents[id(node)] = tangent
+        tangent = tangents.get(id(self)) or [0.0] * width
+        return values[id(self)], tangent[0] if single else tangent
+
+    def taylor(self, var='x', at=0, order=5, point=None):
+        'Taylor coefficients f(at + h) = sum c[k] * h ** k up to order, other vars taken from point'
+        var = self._check_or_create_var(var).var
+        point = dict(point or {})
+        point[var] = at
+        values, series = {}, set()
+        for node in self.plan().nodes:
+            if node.__class__ == Fvar:
+                values[id(node)] = point[node.var]
+                if node.var == var:
+                    values[id(node)] = ([at, 1.0] + [0.0] * order)[:order + 1]
+                    series.add(id(node))
+                continue
+            if node.__class__ == Fconst:
+                values[id(node)] = node.c
+                continue
+            children = node._children()
+            if not any(id(i) in series for i in children):
+                values[id(node)] = node._eval([values[id(i)] for i in children])
+                continue
+            operands = [values[id(i)] if id(i) in series else [values[id(i)]] + [0.0] * order for i in children]
+            values[id(node)] = node._taylor(operands)
+            series.add(id(node))
+        if id(self) in series:
+            return values[id(self)]
+        return [values[id(self)]] + [0.0] * order
+
+    def integrate(self, var, a, b, point=None, tolerance=1e-10):
+        'Definite integral over var from a to b, other vars taken from point; see integrate_many'
+        return self.integrate_many([(a, b)], var, point, tolerance)[0]
+
+    def integrate_many(self, intervals, var='x', point=None, tolerance=1e-10):
+        'Definite integrals over (a, b) intervals: antiderivative if found, else quadrature batched over all intervals'
+        var = self._check_or_create_var(var).var
+        point = dict(point or {})
+        point.pop(var, None)
+        missing = self.free_vars() - frozenset(point) - frozenset([var])
+        if missing:
+            raise ValueError("no values for vars %s" % ', '.join(sorted(missing)))
+        vars = (var,) + tuple(sorted(point))
+        rest = tuple(point[i] for i in vars[1:])
+        try:
+            compiled = self.antiderivative(var).compile(vars)
+            return [compiled(b, *rest) - compiled(a, *rest) for a, b in intervals]
+        except (errors.CantFindAntiDerivativeException, ValueError, ZeroDivisionError, OverflowError):
+            pass
+        try:
+            import numpy
+        except ImportError:
+            compiled = self.compile(vars)
+            evaluate = lambda xs: [compiled(x, *rest) for x in xs]
+        else:
+            arrays = dict(point)
+            def evaluate(xs):
+                arrays[var] = numpy.array(xs)
+                return numpy.broadcast_to(self.evaluate_array(**arrays), (len(xs),)).tolist()
+        return _gauss_kronrod(evaluate, intervals, tolerance)
+
+    def evaluate_many(self, points, workers=None, vars=None, chunksize=10000):
+        'Values at points (dicts, or tuples ordered as vars), in order, using a pool of worker processes'
+        vars = self._ordered_vars(vars)
+        points = self._point_tuples(points, vars)
+        chunks = [points[i:i + chunksize] for i in range(0, len(points), chunksize)]
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers <= 1 or len(chunks) <= 1:
+            compiled = self.compile(vars)
+            return [compiled(*i) for i in points]
+        pool = multiprocessing.Pool(workers, _init_worker, (self.freeze(), vars))
+        try:
+            results = pool.map(_evaluate_chunk, chunks, 1)
+        finally:
+            pool.terminate()
+            pool.join()
+        return [i for chunk in results for i in chunk]
+
+    def evaluate_stream(self, points, vars=None, chunksize=1000, vectorized=False):
+        'Lazily yields values at an iterable of points (dicts, or tuples ordered as vars), holding one chunk at a time'
+        vars = self._ordered_vars(vars)
+        points = iter(points)
+        if vectorized:
+            import numpy
+            out = numpy.empty(chunksize)
+        else:
+            compiled = self.compile(vars)
+        while True:
+            chunk = self._point_tuples(islice(points, chunksize), vars)
+            if not chunk:
+                return
+            if vectorized:
+                columns = numpy.array(chunk, dtype=float).reshape(len(chunk), len(vars))
+                values = self.evaluate_array(out[:len(chunk)], **dict((j, columns[:, i]) for i, j in enumerate(vars)))
+                values = numpy.broadcast_to(values, (len(chunk),)).tolist()
+            else:
+                values = [compiled(*i) for i in chunk]
+            for i in values:
+                yield i
+
+    def _ordered_vars(self, vars):
+        'Names of vars as a tuple, sorted free vars by default'
+        if vars is None:
+            return tuple(sorted(self.free_vars()))
+        return tuple(self._check_or_create_var(i).var for i in vars)
+
+    @staticmethod
+    def _point_tuples(points, vars):
+        return [tuple(i[j] for j in vars) if isinstance(i, dict) else i for i in points]
+
+    def evaluate_array(self, out=None, **arrays):
+        'Evaluates over numpy arrays of var values with broadcasting, walking the tree once'
+        return _array_values(self.plan().nodes, [self], arrays, {id(self): out})[0]
 
     @staticmethod
     def _create_const(num):
@@ -121,27 +485,20 @@ class Function:
         return Funminus(self)
 
     def _priority(self):
-        priority = {
-            Fsum: 1,
-            Fsub: 1,
-            Funminus: 1.5,
-            Fmult: 2,
-            Fdiv: 2,
-            Fpower: 3,
-            Fvar: 4,
-            Fconst: 4,
-            Fsin: 5,
-            Fcos: 5,
-            Fln: 5,
-            Flog: 5,
-        }
-        return priority[self.__class__]
+        return _priorities[self.__class__]
 
     def brace_repr(self, other):
-        if self._priority() < other._priority() or self._priority() == other._priority() and self.__class__ in (Fdiv, Fsin, Fcos, Flog, Fln):
-            return '(' + repr(self) + ')'
-        else:
-            return repr(self)
+        return other._braced(self, repr(self))
+
+    def _needs_braces(self, child):
+        return child._priority() < self._priority() or child._priority() == self._priority() and child.__class__ in (Fdiv, Fsin, Fcos, Flog, Fln)
+
+    def _braced(self, child, string):
+        'string is repr of child, put in braces if needed inside self'
+        return '(' + string + ')' if self._needs_braces(child) else string
+
+    def _wrapped(self, child):
+        return ('(', child, ')') if self._needs_braces(child) else (child,)
 
     def is_zero(self):
         return self.__class__ == Fconst and self.c == 0
@@ -150,55 +507,133 @@ class Function:
         return self.__class__ == Fconst and self.c == 1
 
     def __call__(self, val=None, **args):
-        raise NotImplementedError
+        'Value at named args, or at val for every var'
+        if val is not None and args:
+            raise ValueError("pass either val or named args")
+        return _node_values(self.plan().nodes, args, val)[id(self)]
 
     def __repr__(self):
-        raise NotImplementedError
+        'Rendered once into a list of pieces and joined, then kept on the node'
+        if getattr(self, '_repr', None) is None:
+            pieces = []
+            self._write(pieces.append)
+            self._repr = ''.join(pieces)
+        return self._repr
+
+    def render(self, stream, buffer=4096):
+        'Writes repr to stream (a file-like object) without holding the whole string, in batches of buffer pieces'
+        pieces = []
+
+        def write(piece):
+            pieces.append(piece)
+            if len(pieces) >= buffer:
+                stream.write(''.join(pieces))
+                del pieces[:]
+
+        self._write(write)
+        stream.write(''.join(pieces))
+
+    def _write(self, write):
+        'Passes the pieces of repr to write in order, using reprs already kept on subtrees'
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if item.__class__ == str:
+                write(item)
+            elif getattr(item, '_repr', None) is not None:
+                write(item._repr)
+            else:
+                stack.extend(reversed(item._layout()))
 
     def __eq__(self, other):
+        'Identity, else the same structure with equal leaves, as for x + 2 and x + 2.0 that are interned apart'
+        if self is other:
+            return True
+        return isinstance(other, Function) and self._hash == other._hash and _same_structure(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _der(self, var, derivatives):
+        'Derivative of node given the derivatives of its children'
+        raise NotImplementedError
+
+    def _antider(self, var, integrals, shape):
+        'Antiderivative of node by the rule for its class and shape, given those of the children it integrates through'
+        if not self.depends_on(var):
+            return self * var
+        rule = _antiderivative_rules.get((self.__class__, shape or self._shape(var)))
+        result = rule and rule(self, var, integrals)
+        if result is None:
+            raise errors.CantFindAntiDerivativeException()
+        return result
+
+    def _shape(self, var):
+        'Kind of each child: c if it does not depend on var, x if it is var, f otherwise'
+        return tuple('c' if not i.depends_on(var) else 'x' if i == var else 'f' for i in self._children())
+
+    def _layout(self):
+        'Pieces of repr of node: strings, and children to be written in their place'
         raise NotImplementedError
 
-    def _der(self, var):
+    def _rebuild(self, operands):
+        'Same node over new children, through the operators so that zero and one identities apply'
         raise NotImplementedError
 
-    def _antider(self, var):
+    def _children(self):
+        return ()
+
+    def _emit(self, operands):
+        'Python expression computing node from the expressions of its children'
         raise NotImplementedError
 
-    def _depends_on(self, var):
+    def _array(self, numpy, operands, out):
+        'Numpy ufunc application to the arrays of children, writing into out if given'
         raise NotImplementedError
 
-    @staticmethod
-    def unite_int_or_dict(first, second):
-        'Needed for get_multipliers'
-        if first == None:
-            return second
-        if second == None:
-            return first
-        if first.__class__ == second.__class__ == int:
-            return first + second
-        if first.__class__ == second.__class__ == dict:
-            result = {}
-            for i in first:
-                result[i] = Function.unite_int_or_dict(first[i], second.get(i))
-            for i in second:
-                if not first.has_key(i):
-                    result[i] = second[i]
-            return result
+    def _eval(self, operands):
+        'Value of node from the values of its children'
+        raise NotImplementedError
+
+    def _partials(self):
+        'Derivatives of node with respect to each of its children'
+        raise NotImplementedError
+
+    def _local_grads(self, operands, value):
+        'Numeric _partials, given the values of children and of node itself'
+        raise NotImplementedError
+
+    def _taylor(self, operands):
+        'Truncated Taylor coefficients of node, given those of its children (lists of equal length)'
+        raise NotImplementedError
 
     def __hash__(self):
-        return hash(repr(self))
+        return self._hash
 
     def get_multipliers(self):
-        'Calling only if func has one multiplier, else will be called overloads'
-        return {"up": {self: 1}, "down": {}}
-
-    @staticmethod
-    def inverse_multipliers(multipliers):
-        m = multipliers.copy()
-        t = m["down"]
-        m["down"] = m["up"]
-        m ["up"] = t
-        return m
+        'Factors with their powers in the numerator and denominator, in one sweep from the root over the DAG'
+        weights = {id(self): (1, 0)}
+        up, down = {}, {}
+        for node in reversed(_postorder(self, lambda node: node._multiplier_powers() is not None)):
+            weight = weights.get(id(node))
+            if weight is None:
+                continue
+            powers = node._multiplier_powers()
+            if powers is None:
+                if weight[0]:
+                    up[node] = up.get(node, 0) + weight[0]
+                if weight[1]:
+                    down[node] = down.get(node, 0) + weight[1]
+                continue
+            for child, power in zip(node._children(), powers):
+                side = weight if power > 0 else (weight[1], weight[0])
+                before = weights.get(id(child), (0, 0))
+                weights[id(child)] = (before[0] + side[0] * abs(power), before[1] + side[1] * abs(power))
+        return {"up": up, "down": down}
+
+    def _multiplier_powers(self):
+        'Powers of children as factors of node, None if node is a single multiplier'
+        return None
 
     def get_coef_and_simplify(self):
         multipliers = self.get_multipliers()
@@ -209,7 +644,7 @@ class Function:
             if i.__class__ == Fconst:
                 coef *= i.c ** multipliers["up"][i]
             else:
-                diff = multipliers["up"][i] - (multipliers["down"][i] if multipliers["down"].has_key(i) else 0)
+                diff = multipliers["up"][i] - multipliers["down"].get(i, 0)
                 if diff > 0:
                     up *= i ** diff
                 elif diff < 0:
@@ -217,7 +652,7 @@ class Function:
         for i in multipliers["down"]:
             if i.__class__ == Fconst:
                 coef /= float(i.c) ** multipliers["down"][i]
-            elif not multipliers["up"].has_key(i):
+            elif i not in multipliers["up"]:
                 down *= i ** multipliers["down"][i]
         return (coef, up / down)
 
@@ -226,9 +661,31 @@ class Function:
         return parts[0] * parts[1]
 
     def get_summands(self):
-        'Calling only if func has one summand, else will be called overloads'
-        simplified = self.get_coef_and_simplify()
-        return {simplified[1]: simplified[0]}
+        'Terms simplified by get_coef_and_simplify with their coefficients, in one sweep from the root over the DAG'
+        coefs = {id(self): 1}
+        summands = {}
+        for node in reversed(_postorder(self, lambda node: node._summand_signs() is not None)):
+            coef = coefs.get(id(node))
+            if coef is None:
+                continue
+            signs = node._summand_signs()
+            if signs is None:
+                simplified = node.get_coef_and_simplify()
+                summands[simplified[1]] = summands.get(simplified[1], 0) + coef * simplified[0]
+                continue
+            for child, sign in zip(node._children(), signs):
+                coefs[id(child)] = coefs.get(id(child), 0) + sign * coef
+        return summands
+
+    def _summand_signs(self):
+        'Signs of children as terms of node, None if node is a single summand'
+        return None
+
+    def _normalize(self):
+        'Constant folding, then like-term and power collection of simplify_sum where it applies'
+        if not self.free_vars():
+            return create_const(self())
+        return self.simplify_sum()
 
     def simplify_sum(self):
         free_term = 0
@@ -245,393 +702,1365 @@ class Function:
         return result + free_term if free_term > 0 else result - (-free_term)
 
 
-
 class Fconst(Function):
 
+    __slots__ = ('c',)
+
+    def __reduce__(self):
+        return (Fconst, (self.c,))
+
     def __init__(self, c):
         self.c = c
 
-    def __call__(self, val=None, **args):
-        return self.c
-
-    def __repr__(self):
-        return repr(self.c)
+    def _layout(self):
+        return (repr(self.c),)
 
     def __eq__(self, other):
         if isinstance(other, (int, float, long)):
             return self.c == other
         return other.__class__ == Fconst and self.c == other.c
 
-    def _der(self, var):
+    def _der(self, var, derivatives):
         return Fconst(0)
 
-    def _antider(self, var):
-        return self * var
 
-    def _depends_on(self, var):
-        return False
+class Fvar(Function):
 
+    __slots__ = ('var',)
 
-class Fvar(Function):
+    def __new__(cls, var='x'):
+        return Function.__new__(cls, var)
+
+    def __reduce__(self):
+        return (Fvar, (self.var,))
 
     def __init__(self, var='x'):
         self.var = var
 
-    def __call__(self, val=None, **args):
-        if len(args) == 0 and val is None:
-            raise Exception
-        if val is not None:
-            if len(args) != 0:
-                raise Exception
-            return val
-        return args[self.var]
-
-    def __repr__(self):
-        return self.var
-
-    def __eq__(self, other):
-        return other.__class__ == Fvar and self.var == other.var
+    def _layout(self):
+        return (self.var,)
 
-    def _der(self, var):
-        if var == self.var or self == var:
+    def _der(self, var, derivatives):
+        if self == var:
             return Fconst(1)
         else:
             return Fconst(0)
 
-    def _antider(self, var):
-        if self == var:
-            return self ** 2 / 2
-        else:
-            return self * var
-
-    def _depends_on(self, var):
-        return self == var
-
 
 class Fsum(Function):
 
+    __slots__ = ('left', 'right')
+
     def __init__(self, left, right):
         self.left = left
         self.right = right
 
-    def __call__(self, val=None, **args):
-        return self.left(val, **args) + self.right(val, **args)
+    def _children(self):
+        return (self.left, self.right)
 
-    def __repr__(self):
-        return self.left.brace_repr(self) + ' + ' + self.right.brace_repr(self)
+    def _emit(self, operands):
+        return '%s + %s' % operands
 
-    def __eq__(self, other):
-        return other.__class__ == Fsum and self.left == other.left and self.right == other.right
+    def _array(self, numpy, operands, out):
+        return numpy.add(operands[0], operands[1], out)
 
-    def _der(self, var):
-        return self.left.derivative(var) + self.right.derivative(var)
+    def _eval(self, operands):
+        return operands[0] + operands[1]
 
-    def _antider(self, var):
-        return self.left._antider(var) + self.right._antider(var)
+    def _partials(self):
+        return (Fconst(1), Fconst(1))
 
-    def _depends_on(self, var):
-        return self.left.depends_on(var) or self.right.depends_on(var)
+    def _local_grads(self, operands, value):
+        return (1, 1)
 
-    def get_summands(self):
-        return self.unite_int_or_dict(self.left.get_summands(), self.right.get_summands())
+    def _taylor(self, operands):
+        return [i + j for i, j in zip(operands[0], operands[1])]
+
+    def _rebuild(self, operands):
+        return operands[0] + operands[1]
+
+    def _layout(self):
+        return self._wrapped(self.left) + (' + ',) + self._wrapped(self.right)
+
+    def _der(self, var, derivatives):
+        return derivatives[0] + derivatives[1]
+
+    def _summand_signs(self):
+        return (1, 1)
 
 
 class Fsub(Function):
 
+    __slots__ = ('left', 'right')
+
     def __init__(self, left, right):
         self.left = left
         self.right = right
 
-    def __call__(self, val=None, **args):
-        return self.left(val, **args) - self.right(val, **args)
+    def _children(self):
+        return (self.left, self.right)
 
-    def __repr__(self):
-        return self.left.brace_repr(self) + ' - ' + self.right.brace_repr(self)
+    def _emit(self, operands):
+        return '%s - %s' % operands
 
-    def __eq__(self, other):
-        return other.__class__ == Fsub and self.left == other.left and self.right == other.right
+    def _array(self, numpy, operands, out):
+        return numpy.subtract(operands[0], operands[1], out)
 
-    def _der(self, var):
-        return self.left.derivative(var) - self.right.derivative(var)
+    def _eval(self, operands):
+        return operands[0] - operands[1]
 
-    def _antider(self, var):
-        return self.left._antider(var) - self.right._antider(var)
+    def _partials(self):
+        return (Fconst(1), -Fconst(1))
 
-    def _depends_on(self, var):
-        return self.left.depends_on(var) or self.right.depends_on(var)
+    def _local_grads(self, operands, value):
+        return (1, -1)
 
-    def get_summands(self):
-        right = self.right.get_summands()
-        for i in right:
-            right[i] *= -1
-        return self.unite_int_or_dict(self.left.get_summands(), right)
+    def _taylor(self, operands):
+        return [i - j for i, j in zip(operands[0], operands[1])]
+
+    def _rebuild(self, operands):
+        return operands[0] - operands[1]
+
+    def _layout(self):
+        return self._wrapped(self.left) + (' - ',) + self._wrapped(self.right)
+
+    def _der(self, var, derivatives):
+        return derivatives[0] - derivatives[1]
+
+    def _summand_signs(self):
+        return (1, -1)
 
 
 class Fmult(Function):
 
+    __slots__ = ('left', 'right')
+
     def __init__(self, left, right):
         self.left = left
         self.right = right
 
-    def __call__(self, val=None, **args):
-        return self.left(val, **args) * self.right(val, **args)
+    def _children(self):
+        return (self.left, self.right)
 
-    def __repr__(self):
-        return self.left.brace_repr(self) + ' * ' + self.right.brace_repr(self)
+    def _emit(self, operands):
+        return '%s * %s' % operands
 
-    def __eq__(self, other):
-        return other.__class__ == Fmult and self.left == other.left and self.right == other.right
+    def _array(self, numpy, operands, out):
+        return numpy.multiply(operands[0], operands[1], out)
 
-    def _der(self, var):
-        return self.left.derivative(var) * self.right + self.left * self.right.derivative(var)
+    def _eval(self, operands):
+        return operands[0] * operands[1]
 
-    def _antider(self, var):
-        if not self.left.depends_on(var):
-            return self.left * self.right.antiderivative(var)
-        elif not self.right.depends_on(var):
-            return self.left.antiderivative(var) * self.right
-        else:
-            raise errors.CantFindAntiDerivativeException()
+    def _partials(self):
+        return (self.right, self.left)
 
-    def _depends_on(self, var):
-        return self.left.depends_on(var) or self.right.depends_on(var)
+    def _local_grads(self, operands, value):
+        return (operands[1], operands[0])
 
-    def get_multipliers(self):
-        child_results = {}
-        child_results["left"] = self.left.get_multipliers()
-        child_results["right"] = self.right.get_multipliers()
-        multipliers = self.unite_int_or_dict(child_results["left"], child_results["right"])
-        return multipliers
+    def _taylor(self, operands):
+        return _series_mult(operands[0], operands[1])
+
+    def _rebuild(self, operands):
+        return operands[0] * operands[1]
+
+    def _layout(self):
+        return self._wrapped(self.left) + (' * ',) + self._wrapped(self.right)
+
+    def _der(self, var, derivatives):
+        return derivatives[0] * self.right + self.left * derivatives[1]
+
+    def _multiplier_powers(self):
+        return (1, 1)
 
 
 class Fdiv(Function):
 
+    __slots__ = ('numerator', 'denominator')
+
     def __init__(self, numerator, denominator):
         self.numerator = numerator
         self.denominator = denominator
 
-    def __call__(self, val=None, **args):
-        return self.numerator(val, **args) * 1.0 / self.denominator(val, **args)
+    def _children(self):
+        return (self.numerator, self.denominator)
 
-    def __repr__(self):
-        return self.numerator.brace_repr(self) + ' / ' + self.denominator.brace_repr(self)
+    def _emit(self, operands):
+        return '%s * 1.0 / %s' % operands
 
-    def __eq__(self, other):
-        return other.__class__ == Fdiv and self.numerator == other.numerator and self.denominator == other.denominator
+    def _array(self, numpy, operands, out):
+        return numpy.true_divide(operands[0], operands[1], out)
 
-    def _der(self, var):
-        return ((self.numerator.derivative(var) * self.denominator - self.numerator * self.denominator.derivative(var))
-                / self.denominator ** 2)
+    def _eval(self, operands):
+        return operands[0] * 1.0 / operands[1]
 
-    def _antider(self, var):
-        if not self.denominator.depends_on(var):
-            return self.numerator.antiderivative(var) * self.denominator
-        else:
-            raise errors.CantFindAntiDerivativeException()
+    def _partials(self):
+        return (1 / self.denominator, -(self.numerator / self.denominator ** 2))
 
-    def _depends_on(self, var):
-        return self.numerator.depends_on(var) or self.denominator.depends_on(var)
+    def _local_grads(self, operands, value):
+        return (1.0 / operands[1], -value / operands[1])
 
-    def get_multipliers(self):
-        child_results = {}
-        child_results["num"] = self.numerator.get_multipliers()
-        child_results["den"] = self.denominator.get_multipliers()
-        multipliers = self.unite_int_or_dict(child_results["num"], self.inverse_multipliers(child_results["den"]))
-        return multipliers
+    def _taylor(self, operands):
+        return _series_div(operands[0], operands[1])
+
+    def _rebuild(self, operands):
+        return operands[0] / operands[1]
+
+    def _layout(self):
+        return self._wrapped(self.numerator) + (' / ',) + self._wrapped(self.denominator)
+
+    def _der(self, var, derivatives):
+        return ((derivatives[0] * self.denominator - self.numerator * derivatives[1])
+                / self.denominator ** 2)
+
+    def _multiplier_powers(self):
+        return (1, -1)
 
 class Fpower(Function):
 
+    __slots__ = ('f', 'power')
+
     def __init__(self, f, power):
         self.f = f
         self.power = power
 
-    def __call__(self, val=None, **args):
-        return self.f(val, **args) ** self.power(val, **args)
+    def _children(self):
+        return (self.f, self.power)
 
-    def __repr__(self):
-        return self.f.brace_repr(self) + ' ** ' + self.power.brace_repr(self)
+    def _emit(self, operands):
+        return '%s ** %s' % operands
 
-    def __eq__(self, other):
-        return other.__class__ == Fpower and self.f == other.f and self.power == other.power
+    def _array(self, numpy, operands, out):
+        return numpy.power(operands[0], operands[1], out)
+
+    def _eval(self, operands):
+        return operands[0] ** operands[1]
 
-    def _der(self, var):
+    def _partials(self):
+        power = _const_value(self.power)
+        if power is not None:
+            return (self.power * self.f ** (power - 1), Fconst(0))
+        elif _const_value(self.f) is not None:
+            return (Fconst(0), self * Fln(self.f))
+        else:
+            return (self * self.power / self.f, self * Fln(self.f))
+
+    def _local_grads(self, operands, value):
+        'The partial by the power is nan at bases without a real log, so that the one by the base still comes out'
+        base, power = operands
+        if _const_value(self.power) is not None:
+            return (power * base ** (power - 1), 0)
+        log = math.log(base) if base > 0 else float('nan')
+        if _const_value(self.f) is not None:
+            return (0, value * log)
+        return (value * power / base, value * log)
+
+    def _taylor(self, operands):
+        base, power = operands
+        if any(power[1:]):
+            return _series_exp(_series_mult(power, _series_ln(base)))
+        power = power[0]
+        if base[0] != 0:
+            return _series_pow(base, power)
+        if power != int(power) or power < 0:
+            raise ValueError('Power series of %s ** %s at zero base' % (self.f, power))
+        result = [1.0] + [0.0] * (len(base) - 1)
+        for i in range(int(power)):
+            result = _series_mult(result, base)
+        return result
+
+    def _rebuild(self, operands):
+        return operands[0] ** operands[1]
+
+    def _layout(self):
+        return self._wrapped(self.f) + (' ** ',) + self._wrapped(self.power)
+
+    def _der(self, var, derivatives):
         if self.power.__class__ == Fconst:
-            return self.power * self.f ** (self.power.c - 1) * self.f.derivative(var)
+            return self.power * self.f ** (self.power.c - 1) * derivatives[0]
         elif self.f.__class__ == Fconst:
-            return self * Fln(self.f) * self.power.derivative(var)
+            return self * Fln(self.f) * derivatives[1]
         else:
-            return self * (Fln(self.f) * self.power.derivative(var) + (self.power * self.f.derivative(var)) / self.f)
+            return self * (Fln(self.f) * derivatives[1] + (self.power * derivatives[0]) / self.f)
 
-    def _depends_on(self, var):
-        return self.f.depends_on(var) or self.power.depends_on(var)
-
-    def _antider(self, var):
-        if self.f == var and self.power.__class__ == Fconst:
-            c = Fconst(self.power.c + 1)
-            return self.f ** c / c
-        elif self.f.__class__ == Fconst and self.power == var:
-            return self / math.ln(self.f.c)
-        else:
-            raise errors.CantFindAntiDerivativeException()
-
-    def get_multipliers(self):
-        if self.power.__class__ == Funminus:
-            inverse = Fpower(self.f, self.power.arg).get_multipliers()
-            return self.inverse_multipliers(inverse)
-        if self.power.__class__ == Fconst:
-            arg_multipliers = self.f.get_multipliers()
-            for i in arg_multipliers:
-                for j in arg_multipliers[i]:
-                    arg_multipliers[i][j] = arg_multipliers[i][j] * self.power.c
-            return arg_multipliers
-        raise NotImplementedError()
+    def _multiplier_powers(self):
+        'Only constant powers are collected; the power itself is not a factor'
+        power = self.power.arg if self.power.__class__ == Funminus else self.power
+        if power.__class__ != Fconst:
+            return None
+        return (-power.c,) if power is not self.power else (power.c,)
 
 
 class Fsin(Function):
 
+    __slots__ = ('arg',)
+
     def __init__(self, arg):
         self.arg = arg
 
-    def __call__(self, val=None, **args):
-        return math.sin(self.arg(val, **args))
+    def _children(self):
+        return (self.arg,)
 
-    def __repr__(self):
-        return 'sin' + self.arg.brace_repr(self)
+    def _emit(self, operands):
+        return 'sin(%s)' % operands
 
-    def __eq__(self, other):
-        return other.__class__ == Fsin and self.arg == other.arg
+    def _array(self, numpy, operands, out):
+        return numpy.sin(operands[0], out)
 
-    def _der(self, var):
-        return Fcos(self.arg) * self.arg.derivative(var)
+    def _eval(self, operands):
+        return math.sin(operands[0])
 
-    def _depends_on(self, var):
-        return self.arg.depends_on(var)
+    def _partials(self):
+        return (Fcos(self.arg),)
 
-    def _antider(self, var):
-        if self.arg == var:
-            return -Fcos(var)
-        else:
-            raise errors.CantFindAntiDerivativeException()
+    def _local_grads(self, operands, value):
+        return (math.cos(operands[0]),)
+
+    def _taylor(self, operands):
+        return _series_sin_cos(operands[0])[0]
+
+    def _rebuild(self, operands):
+        return Fsin(operands[0])
+
+    def _layout(self):
+        return ('sin',) + self._wrapped(self.arg)
+
+    def _der(self, var, derivatives):
+        return Fcos(self.arg) * derivatives[0]
 
 
 class Fcos(Function):
 
+    __slots__ = ('arg',)
+
     def __init__(self, arg):
         self.arg = arg
 
-    def __call__(self, val=None, **args):
-        return math.cos(self.arg(val, **args))
+    def _children(self):
+        return (self.arg,)
 
-    def __repr__(self):
-        return 'cos' + self.arg.brace_repr(self)
+    def _emit(self, operands):
+        return 'cos(%s)' % operands
 
-    def __eq__(self, other):
-        return other.__class__ == Fcos and self.arg == other.arg
+    def _array(self, numpy, operands, out):
+        return numpy.cos(operands[0], out)
 
-    def _der(self, var):
-        return -Fsin(self.arg) * self.arg.derivative(var)
+    def _eval(self, operands):
+        return math.cos(operands[0])
 
-    def _depends_on(self, var):
-        return self.arg.depends_on(var)
+    def _partials(self):
+        return (-Fsin(self.arg),)
 
-    def _antider(self, var):
-        if self.arg == var:
-            return Fsin(var)
-        else:
-            raise errors.CantFindAntiDerivativeException()
+    def _local_grads(self, operands, value):
+        return (-math.sin(operands[0]),)
+
+    def _taylor(self, operands):
+        return _series_sin_cos(operands[0])[1]
+
+    def _rebuild(self, operands):
+        return Fcos(operands[0])
+
+    def _layout(self):
+        return ('cos',) + self._wrapped(self.arg)
+
+    def _der(self, var, derivatives):
+        return -Fsin(self.arg) * derivatives[0]
 
 
 class Funminus(Function):
 
+    __slots__ = ('arg',)
+
     def __init__(self, arg):
         self.arg = arg
 
-    def __call__(self, val=None, **args):
-        return -(self.arg(val, **args))
+    def _children(self):
+        return (self.arg,)
 
-    def __repr__(self):
-        return '-' + self.arg.brace_repr(self)
+    def _emit(self, operands):
+        return '-%s' % operands
 
-    def __eq__(self, other):
-        return other.__class__ == Funminus and self.arg == other.arg
+    def _array(self, numpy, operands, out):
+        return numpy.negative(operands[0], out)
 
-    def _der(self, var):
-        return -self.arg.derivative(var)
+    def _eval(self, operands):
+        return -operands[0]
 
-    def _depends_on(self, var):
-        return self.arg.depends_on(var)
+    def _partials(self):
+        return (-Fconst(1),)
 
-    def _antider(self, var):
-        return -self.arg.antiderivative()
+    def _local_grads(self, operands, value):
+        return (-1,)
 
-    def get_summands(self):
-        arg_summands = self.arg.get_summands()
-        for i in arg_summands:
-            arg_summands[i] *= -1
-        return arg_summands
+    def _taylor(self, operands):
+        return [-i for i in operands[0]]
+
+    def _rebuild(self, operands):
+        return -operands[0]
+
+    def _layout(self):
+        return ('-',) + self._wrapped(self.arg)
+
+    def _der(self, var, derivatives):
+        return -derivatives[0]
+
+    def _summand_signs(self):
+        return (-1,)
 
 
 class Fln(Function):
 
+    __slots__ = ('arg',)
+
     def __init__(self, arg):
         self.arg = arg
 
-    def __call__(self, val=None, **args):
-        return math.log(self.arg(val, **args))
+    def _children(self):
+        return (self.arg,)
 
-    def __repr__(self):
-        return 'ln' + self.arg.brace_repr(self)
+    def _emit(self, operands):
+        return 'log(%s)' % operands
 
-    def __eq__(self, other):
-        return other.__class__ == Fln and self.arg == other.arg
+    def _array(self, numpy, operands, out):
+        return numpy.log(operands[0], out)
 
-    def _der(self, var):
-        return self.arg.derivative(var) / self.arg
+    def _eval(self, operands):
+        return math.log(operands[0])
 
-    def _depends_on(self, var):
-        return self.arg.depends_on(var)
+    def _partials(self):
+        return (1 / self.arg,)
 
-    def _antider(self, var):
-        if self.arg == var:
-            return var * self - var
-        else:
-            raise errors.CantFindAntiDerivativeException()
+    def _local_grads(self, operands, value):
+        return (1.0 / operands[0],)
+
+    def _taylor(self, operands):
+        return _series_ln(operands[0])
+
+    def _rebuild(self, operands):
+        return Fln(operands[0])
+
+    def _layout(self):
+        return ('ln',) + self._wrapped(self.arg)
+
+    def _der(self, var, derivatives):
+        return derivatives[0] / self.arg
 
 
 class Flog(Function):
 
+    __slots__ = ('base', 'arg')
+
     def __init__(self, base, arg):
         self.base = base
         self.arg = arg
 
-    def __call__(self, val=None, **args):
-        return math.log(self.base(val, **args), self.arg(val, **args))
+    def _children(self):
+        return (self.base, self.arg)
 
-    def __repr__(self):
-        return 'log[' + repr(self.base) + ']' + self.arg.brace_repr(self)
+    def _emit(self, operands):
+        return 'log(%s, %s)' % operands[::-1]
+
+    def _array(self, numpy, operands, out):
+        base = numpy.log(operands[0])
+        return numpy.true_divide(numpy.log(operands[1], out), base, out)
+
+    def _eval(self, operands):
+        return math.log(operands[1], operands[0])
+
+    def _partials(self):
+        return (-(self / (self.base * Fln(self.base))), 1 / (self.arg * Fln(self.base)))
+
+    def _local_grads(self, operands, value):
+        return (-value / (operands[0] * math.log(operands[0])), 1.0 / (operands[1] * math.log(operands[0])))
+
+    def _taylor(self, operands):
+        return _series_div(_series_ln(operands[1]), _series_ln(operands[0]))
+
+    def _rebuild(self, operands):
+        return Flog(operands[0], operands[1])
+
+    def _layout(self):
+        return ('log[', self.base, ']') + self._wrapped(self.arg)
 
     def __eq__(self, other):
-        return (other.__class__ == Flog and self.arg == other.arg and self.base == other.base or
-                other._class__ == Fln and self.base == math.e and self.arg == other.arg)
+        return Function.__eq__(self, other) or other.__class__ == Fln and self.base == math.e and self.arg is other.arg
 
-    def _der(self, var):
-        return (Fln(self.arg).derivative(var) - Fln(self.base).derivative(var) * self) / Fln(self.base)
+    def _der(self, var, derivatives):
+        return (derivatives[1] / self.arg - derivatives[0] / self.base * self) / Fln(self.base)
 
-    def _depends_on(self, var):
-        return self.arg.depends_on(var) or self.base.depends_on(var)
 
-    def _antider(self, var):
-        if self.arg == var and self.base.__class__ == Fconst:
-            return var * self - math.log(math.e, self.base.c) * var
-        else:
-            raise errors.CantFindAntiDerivativeException()
+class Fderivative(Function):
+    'Derivative of f by var, expanded one level at a time when its children are first asked for'
+
+    __slots__ = ('f', 'var', '_expansion')
+
+    def __reduce__(self):
+        return (Fderivative, (self.f, self.var))
+
+    def __init__(self, f, var):
+        self.f = f
+        self.var = var
+
+    def expand(self):
+        'The rule of f over lazy derivatives of its children, built once'
+        if getattr(self, '_expansion', None) is None:
+            derivatives = [i.derivative(self.var, lazy=True) for i in self.f._children()]
+            self._expansion = self.f._der(self.var, derivatives)
+        return self._expansion
+
+    def _children(self):
+        return (self.expand(),)
+
+    def _emit(self, operands):
+        return operands[0]
+
+    def _array(self, numpy, operands, out):
+        if out is None:
+            return operands[0]
+        numpy.copyto(out, operands[0])
+        return out
+
+    def _eval(self, operands):
+        return operands[0]
+
+    def _partials(self):
+        return (Fconst(1),)
+
+    def _local_grads(self, operands, value):
+        return (1,)
+
+    def _taylor(self, operands):
+        return operands[0]
+
+    def _rebuild(self, operands):
+        return operands[0]
+
+    def _layout(self):
+        return ('d/d' + self.var.var, '(', self.f, ')')
+
+    def _der(self, var, derivatives):
+        return derivatives[0]
 
 
 var, sin, cos, ln, log = Fvar, Fsin, Fcos, Fln, Flog
 
+_priorities = {Fsum: 1, Fsub: 1, Funminus: 1.5, Fmult: 2, Fdiv: 2, Fpower: 3,
+               Fvar: 4, Fconst: 4, Fsin: 5, Fcos: 5, Fln: 5, Flog: 5, Fderivative: 5}
+
+_node_classes = (Fconst, Fvar, Fsum, Fsub, Fmult, Fdiv, Fpower, Fsin, Fcos, Funminus, Fln, Flog, Fderivative)
+
+
+class DerivativeCache(object):
+    'Memo of derivatives by (node, var), kept on the node so it goes with it; least recently used evicted beyond maxsize'
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, node, var):
+        memo = getattr(node, '_memo', None) or ()
+        for i in range(0, len(memo), 3):
+            if memo[i] is self and memo[i + 1] == var:
+                self.hits += 1
+                key = (id(node), var)
+                self._entries[key] = self._entries.pop(key)
+                return memo[i + 2]
+        self.misses += 1
+        return None
+
+    def put(self, node, var, result):
+        if self.maxsize <= 0:
+            return
+        node._memo = self._without(node, var) + (self, var, result)
+        key = (id(node), var)
+        self._entries.pop(key, None)
+        self._entries[key] = weakref.KeyedRef(node, self._dropped, key)
+        if len(self._entries) > self.maxsize:
+            self._forget(*self._entries.popitem(last=False))
+
+    def _without(self, node, var):
+        'Flat (cache, var, result) triples of node, a tuple being smaller than a dict, less the one of this cache and var'
+        memo = getattr(node, '_memo', None) or ()
+        for i in range(0, len(memo), 3):
+            if memo[i] is self and memo[i + 1] == var:
+                return memo[:i] + memo[i + 3:]
+        return memo
+
+    def _dropped(self, ref):
+        if self._entries.get(ref.key) is ref:
+            del self._entries[ref.key]
+
+    def _forget(self, key, ref):
+        node = ref()
+        if node is not None:
+            node._memo = self._without(node, key[1])
+
+    def clear(self):
+        'Drops every entry; entries also go when their node is no longer referenced'
+        while self._entries:
+            self._forget(*self._entries.popitem())
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+derivative_cache = DerivativeCache()
+simplified_derivative_cache = DerivativeCache()
+antiderivative_cache = DerivativeCache()
+
+
+class DiskCache(object):
+    'Derivatives, simplified forms and compiled code in a directory, keyed by digest(), least recently used evicted beyond maxbytes'
+
+    def __init__(self, directory, maxbytes=64 * 2 ** 20):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = sum(os.path.getsize(i) for i in self._files())
+
+    def derivative(self, function, var='x', simplify=False):
+        'function.derivative(var, simplify), read from disk when this derivative was stored before'
+        vars = var if isinstance(var, list) else [var]
+        key = ('derivative', function.digest(), [Function._check_or_create_var(i).var for i in vars], simplify)
+        tape = self._load(key)
+        if tape is not None:
+            return tape.thaw()
+        result = function.derivative(var, simplify)
+        self._store(key, result.freeze())
+        return result
+
+    def simplified(self, function):
+        'function.simplify_sum(), read from disk when stored before'
+        key = ('simplified', function.digest())
+        tape = self._load(key)
+        if tape is not None:
+            return tape.thaw()
+        result = function.simplify_sum()
+        self._store(key, result.freeze())
+        return result
+
+    def compile(self, function, vars=None):
+        'function.compile(vars), reusing generated source from disk; also fills the in-memory compile cache'
+        if vars is not None:
+            vars = tuple(Function._check_or_create_var(i).var for i in vars)
+        if getattr(function, '_compiled', None) is None:
+            function._compiled = {}
+        if vars not in function._compiled:
+            key = ('compiled', function.digest(), vars)
+            stored = self._load(key)
+            if stored is None:
+                compiled = function.compile(vars)
+                self._store(key, (compiled.source, compiled.vars))
+            else:
+                function._compiled[vars] = _exec_compiled(stored[0], stored[1], '<function>')
+        return function._compiled[vars]
+
+    def clear(self):
+        for i in self._files():
+            os.remove(i)
+        self._bytes = 0
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'files': len(self._files()),
+                'bytes': self._bytes, 'maxbytes': self.maxbytes}
+
+    def _files(self):
+        return [os.path.join(self.directory, i) for i in os.listdir(self.directory) if i.endswith('.pickle')]
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key)).hexdigest() + '.pickle')
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as stream:
+                value = pickle.load(stream)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(path, None)
+        self.hits += 1
+        return value
+
+    def _store(self, key, value):
+        'Written to a temporary file and renamed, so concurrent readers never see a partial entry'
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(descriptor, 'wb') as stream:
+            pickle.dump(value, stream, 2)
+        path = self._path(key)
+        if os.path.exists(path):
+            self._bytes -= os.path.getsize(path)
+        os.rename(temporary, path)
+        self._bytes += os.path.getsize(path)
+        if self._bytes > self.maxbytes:
+            self._evict()
+
+    def _evict(self):
+        files = sorted((os.path.getmtime(i), i) for i in self._files())
+        while files and self._bytes > self.maxbytes:
+            path = files.pop(0)[1]
+            self._bytes -= os.path.getsize(path)
+            os.remove(path)
+
+
+class Plan(object):
+    'Distinct nodes of a tree, children first, so that every shared subtree is computed once per point'
+
+    def __init__(self, function):
+        'Interning makes structurally equal subtrees one object, so deduplicating by identity is enough'
+        self.function = function
+        self.nodes = _postorder(function)
+        sizes = {}
+        depths = {}
+        self.class_counts = {}
+        for node in self.nodes:
+            sizes[id(node)] = 1 + sum(sizes[id(i)] for i in node._children())
+            depths[id(node)] = 1 + max([depths[id(i)] for i in node._children()] or [0])
+            name = node.__class__.__name__
+            self.class_counts[name] = self.class_counts.get(name, 0) + 1
+        self.tree_size = sizes[id(function)]
+        self.depth = depths[id(function)]
+        self.deduplicated = self.tree_size - len(self.nodes)
+
+    def __repr__(self):
+        return '<Plan: %d nodes, %d of %d deduplicated>' % (len(self.nodes), self.deduplicated, self.tree_size)
+
+
+class Profile(object):
+    'Invocation counts and seconds per (class name, method), collected inside profile()'
+
+    methods = ('_der', '_antider', '__call__', '_eval', '__eq__', '__hash__')
+
+    def __init__(self):
+        self.counts = {}
+        self.seconds = {}
+        self._node_seconds = {}
+
+    def _record(self, cls, name, node, elapsed):
+        key = (cls.__name__, name)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.seconds[key] = self.seconds.get(key, 0) + elapsed
+        if name in ('_der', '_antider', '_eval'):
+            entry = self._node_seconds.setdefault((name, id(node)), [node, 0])
+            entry[1] += elapsed
+
+    def hot_nodes(self, n=10):
+        'The n (seconds, method, node) with the most time spent in _der, _antider or _eval of that node'
+        hot = [(seconds, key[0], node) for key, (node, seconds) in self._node_seconds.items()]
+        return sorted(hot, key=lambda i: -i[0])[:n]
+
+    def report(self):
+        lines = ['%-10s %-10s %9s %10s' % ('class', 'method', 'calls', 'seconds')]
+        for key in sorted(self.counts, key=lambda i: -self.seconds[i]):
+            lines.append('%-10s %-10s %9d %10.5f' % (key[0], key[1], self.counts[key], self.seconds[key]))
+        return '\n'.join(lines)
+
+
+def _profiled(profile, cls, name, method):
+    def profiled(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            profile._record(cls, name, self, time.time() - start)
+    return profiled
+
+
+@contextmanager
+def profile():
+    'Counts and times Profile.methods of every node class until the block exits; no overhead outside of it'
+    result = Profile()
+    saved = []
+    for cls in _node_classes:
+        for name in Profile.methods:
+            saved.append((cls, name, cls.__dict__.get(name)))
+            setattr(cls, name, _profiled(result, cls, name, getattr(cls, name)))
+    try:
+        yield result
+    finally:
+        for cls, name, method in reversed(saved):
+            if method is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, method)
+
+
+class Tape(object):
+    'Expression frozen into flat arrays: an opcode and two operand indices per distinct node, children first'
+
+    _classes = _node_classes
+
+    def __init__(self, function):
+        'Operands index earlier nodes, or consts for Fconst and names for Fvar; -1 if absent. Fderivative is expanded'
+        self.opcodes = array('B')
+        self.left = array('i')
+        self.right = array('i')
+        self.consts = []
+        self.names = []
+        index = {}
+        for node in _postorder(function):
+            if node.__class__ == Fderivative:
+                index[id(node)] = index[id(node.expand())]
+                continue
+            index[id(node)] = len(self.opcodes)
+            self.opcodes.append(Tape._classes.index(node.__class__))
+            if node.__class__ == Fconst:
+                operands = (len(self.consts), -1)
+                self.consts.append(node.c)
+            elif node.__class__ == Fvar:
+                operands = (len(self.names), -1)
+                self.names.append(node.var)
+            else:
+                operands = tuple(index[id(i)] for i in node._children()) + (-1,)
+            self.left.append(operands[0])
+            self.right.append(operands[1])
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def nbytes(self):
+        return sum(i.itemsize * len(i) for i in (self.opcodes, self.left, self.right))
+
+    def __getstate__(self):
+        return (self.opcodes.tostring(), self.left.tostring(), self.right.tostring(), self.consts, self.names)
+
+    def __setstate__(self, state):
+        self.opcodes, self.left, self.right = array('B'), array('i'), array('i')
+        self.opcodes.fromstring(state[0])
+        self.left.fromstring(state[1])
+        self.right.fromstring(state[2])
+        self.consts, self.names = state[3], state[4]
+
+    def thaw(self):
+        'Rebuilds the (interned) Function'
+        nodes = []
+        for opcode, left, right in zip(self.opcodes, self.left, self.right):
+            cls = Tape._classes[opcode]
+            if cls == Fconst:
+                nodes.append(Fconst(self.consts[left]))
+            elif cls == Fvar:
+                nodes.append(Fvar(self.names[left]))
+            elif right < 0:
+                nodes.append(cls(nodes[left]))
+            else:
+                nodes.append(cls(nodes[left], nodes[right]))
+        return nodes[-1]
+
+
+class SparseMatrix(object):
+    'Matrix of functions keeping only the entries that are not structurally zero, row by row'
+
+    def __init__(self, shape, entries, vars):
+        'entries maps (row, column) to a nonzero Function; vars name the columns where they stand for derivatives'
+        self.shape = shape
+        self.entries = entries
+        self.vars = vars
+        self._compiled = {}
+
+    def __getitem__(self, index):
+        return self.entries.get(index, _zero)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def dense(self):
+        'List of rows, zeros included'
+        return [[self[i, j] for j in range(self.shape[1])] for i in range(self.shape[0])]
+
+    def compile(self, vars=None):
+        'Plain python function of args ordered as vars (self.vars by default) returning rows, columns, values'
+        vars = tuple(Function._check_or_create_var(i).var for i in (self.vars if vars is None else vars))
+        if vars not in self._compiled:
+            keys = sorted(self.entries)
+            functions = [self.entries[i] for i in keys]
+            namespace = {'rows': tuple(i[0] for i in keys), 'columns': tuple(i[1] for i in keys)}
+            self._compiled[vars] = _compile_nodes(
+                _merged_nodes(functions), functions, vars, '<sparse matrix>', namespace, 'rows, columns, %s')
+        return self._compiled[vars]
+
+    def __repr__(self):
+        return '<SparseMatrix %dx%d: %d nonzero>' % (self.shape + (len(self.entries),))
+
+
+class FunctionBank(object):
+    'Several functions evaluated together: their distinct nodes form one schedule, so shared subtrees are computed once'
+
+    def __init__(self, functions):
+        'Interning has already merged structurally equal subtrees into one object'
+        self.functions = [create_const(i) if isinstance(i, (int, float, long)) else i for i in functions]
+        self.nodes = _merged_nodes(self.functions)
+        self.vars = _matrix_vars(self.functions, None)
+        self._compiled = {}
+
+    def __len__(self):
+        return len(self.functions)
+
+    def __call__(self, val=None, **args):
+        'Values of all functions at named args, or at val for every var'
+        if val is not None and args:
+            raise ValueError("pass either val or named args")
+        values = _node_values(self.nodes, args, val)
+        return [values[id(i)] for i in self.functions]
+
+    def compile(self, vars=None):
+        'Plain python function of positional args, ordered as vars (self.vars by default), returning the list of values'
+        vars = self.vars if vars is None else tuple(Function._check_or_create_var(i).var for i in vars)
+        if vars not in self._compiled:
+            self._compiled[vars] = _compile_nodes(self.nodes, self.functions, vars, '<function bank>')
+        return self._compiled[vars]
+
+    def evaluate_array(self, **arrays):
+        'Values of all functions over numpy arrays of var values with broadcasting, in one pass'
+        return _array_values(self.nodes, self.functions, arrays)
+
+    def stats(self):
+        'Nodes in the merged schedule against the sum of the separate plans'
+        separate = sum(len(i.plan().nodes) for i in self.functions)
+        return {'functions': len(self.functions), 'nodes': len(self.nodes),
+                'separate': separate, 'shared': separate - len(self.nodes)}
+
+    def __repr__(self):
+        return '<FunctionBank: %d functions, %d nodes>' % (len(self.functions), len(self.nodes))
+
 
 def create_function(function):
     varnames = function.func_code.co_varnames
     return function(*(Fvar(i) for i in varnames))
 
 create_const = Function._create_const
+
+
+_zero = create_const(0)
+
+
+def _matrix_vars(functions, vars):
+    if vars is None:
+        return tuple(sorted(reduce(frozenset.union, (i.free_vars() for i in functions), _no_vars)))
+    return tuple(Function._check_or_create_var(i).var for i in vars)
+
+
+def jacobian(functions, vars=None):
+    'Derivatives of functions by vars (sorted free vars by default), differentiating only where a function depends on a var'
+    functions = [create_const(i) if isinstance(i, (int, float, long)) else i for i in functions]
+    vars = _matrix_vars(functions, vars)
+    entries = {}
+    for i, function in enumerate(functions):
+        for j, var in enumerate(vars):
+            if var in function.free_vars():
+                derivative = function.derivative(var)
+                if derivative != 0:
+                    entries[i, j] = derivative
+    return SparseMatrix((len(functions), len(vars)), entries, vars)
+
+
+def hessian(function, vars=None):
+    'Second derivatives of function by pairs of vars, each symmetric pair differentiated once'
+    vars = _matrix_vars([function], vars)
+    gradient = jacobian([function], vars)
+    entries = {}
+    for (_, i), first in gradient.entries.items():
+        for j in range(i, len(vars)):
+            if vars[j] in first.free_vars():
+                second = first.derivative(vars[j])
+                if second != 0:
+                    entries[i, j] = entries[j, i] = second
+    return SparseMatrix((len(vars), len(vars)), entries, vars)
+
+
+_no_vars = frozenset()
+
+
+def _const_value(function):
+    'The number of an Fconst or its negation (see create_const), else None'
+    if function.__class__ == Fconst:
+        return function.c
+    if function.__class__ == Funminus and function.arg.__class__ == Fconst:
+        return -function.arg.c
+    return None
+
+
+def _same_structure(a, b):
+    'Whether a and b are built by the same constructors from equal leaf values, without recursion'
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if a is b:
+            continue
+        if a.__class__ != b.__class__ or a._hash != b._hash:
+            return False
+        for i, j in zip(a.__reduce__()[1], b.__reduce__()[1]):
+            if isinstance(i, Function) and isinstance(j, Function):
+                stack.append((i, j))
+            elif i != j:
+                return False
+    return True
+
+
+def _postorder(function, expand=None):
+    'Distinct node objects of the tree, children before parents; children of nodes failing expand are skipped'
+    order = []
+    seen = set()
+    stack = [(function, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node)
+        elif id(node) not in seen:
+            seen.add(id(node))
+            stack.append((node, True))
+            if expand is None or expand(node):
+                stack.extend((i, False) for i in reversed(node._children()))
+    return order
+
+
+def _fold(function, combine, expand=None):
+    'combine(node, results of its children) bottom-up over the distinct nodes, without recursion'
+    results = {}
+    for node in _postorder(function, expand):
+        results[id(node)] = combine(node, [results.get(id(i)) for i in node._children()])
+    return results[id(function)]
+
+
+def _node_values(nodes, point, val=None):
+    'Values of nodes (children before parents) at point, or at val for every var'
+    values = {}
+    for node in nodes:
+        if node.__class__ == Fvar:
+            values[id(node)] = point[node.var] if val is None else val
+        elif node.__class__ == Fconst:
+            values[id(node)] = node.c
+        else:
+            values[id(node)] = node._eval([values[id(i)] for i in node._children()])
+    return values
+
+
+def _array_values(nodes, outputs, arrays, outs=None):
+    'Arrays of outputs over nodes (children first); intermediate buffers are reused once their last parent is done'
+    import numpy
+    outs = outs or {}
+    uses = {}
+    for node in nodes:
+        for i in node._children():
+            uses[id(i)] = uses.get(id(i), 0) + 1
+    for i in outputs:
+        uses[id(i)] = uses.get(id(i), 0) + 1
+    values = {}
+    owned = set()
+    free = []
+    for node in nodes:
+        if node.__class__ in (Fvar, Fconst):
+            if node.__class__ == Fvar:
+                values[id(node)] = numpy.asarray(arrays[node.var], dtype=float)
+            else:
+                values[id(node)] = float(node.c)
+            if outs.get(id(node)) is not None:
+                numpy.copyto(outs[id(node)], values[id(node)])
+                values[id(node)] = outs[id(node)]
+            continue
+        operands = [values[id(i)] for i in node._children()]
+        for i in node._children():
+            uses[id(i)] -= 1
+            if uses[id(i)] == 0 and id(i) in owned:
+                free.append(values.pop(id(i)))
+        shape = numpy.broadcast(*operands).shape
+        if outs.get(id(node)) is not None:
+            buffer = outs[id(node)]
+        elif not shape:
+            buffer = None
+        else:
+            buffer = next((i for i in free if i.shape == shape), None)
+            if buffer is None:
+                buffer = numpy.empty(shape)
+            else:
+                free = [i for i in free if i is not buffer]
+            owned.add(id(node))
+        values[id(node)] = node._array(numpy, operands, buffer)
+    return [values[id(i)] for i in outputs]
+
+
+def _series_mult(a, b):
+    return [sum(a[j] * b[k - j] for j in range(k + 1)) for k in range(len(a))]
+
+
+def _series_div(a, b):
+    result = []
+    for k in range(len(a)):
+        result.append((a[k] - sum(b[j] * result[k - j] for j in range(1, k + 1))) / float(b[0]))
+    return result
+
+
+def _series_pow(a, power):
+    'Series of a ** power for a constant power, a[0] != 0'
+    result = [a[0] ** power]
+    for k in range(1, len(a)):
+        total = sum(((power + 1) * j - k) * a[j] * result[k - j] for j in range(1, k + 1))
+        result.append(total / (k * float(a[0])))
+    return result
+
+
+def _series_exp(a):
+    result = [math.exp(a[0])]
+    for k in range(1, len(a)):
+        result.append(sum(j * a[j] * result[k - j] for j in range(1, k + 1)) / float(k))
+    return result
+
+
+def _series_ln(a):
+    result = [math.log(a[0])]
+    for k in range(1, len(a)):
+        total = sum(j * result[j] * a[k - j] for j in range(1, k))
+        result.append((a[k] - total / float(k)) / a[0])
+    return result
+
+
+def _series_sin_cos(a):
+    sines, cosines = [math.sin(a[0])], [math.cos(a[0])]
+    for k in range(1, len(a)):
+        sines.append(sum(j * a[j] * cosines[k - j] for j in range(1, k + 1)) / float(k))
+        cosines.append(-sum(j * a[j] * sines[k - j] for j in range(1, k + 1)) / float(k))
+    return sines, cosines
+
+
+_kronrod_abscissae = (0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+                      0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+                      0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+                      0.207784955007898467600689403773245)
+_kronrod_nodes = tuple(-i for i in _kronrod_abscissae) + (0.0,) + _kronrod_abscissae[::-1]
+_kronrod_weights = (0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                    0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                    0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                    0.204432940075298892414161999234649)
+_kronrod_weights = _kronrod_weights + (0.209482141084727828012999174891714,) + _kronrod_weights[::-1]
+_gauss_weights = (0, 0.129484966168869693270611432679082, 0, 0.279705391489276667901467771423780,
+                  0, 0.381830050505118944950369775488975, 0)
+_gauss_weights = _gauss_weights + (0.417959183673469387755102040816327,) + _gauss_weights[::-1]
+
+
+def _gauss_kronrod(evaluate, intervals, tolerance, limit=1000):
+    'Adaptive Gauss-Kronrod (G7, K15): worst pieces halved first, one evaluate call per round, at most limit pieces'
+    pieces = [[] for i in intervals]
+    pending = [(i, a, b) for i, (a, b) in enumerate(intervals) if a != b]
+    while pending:
+        points = [(a + b) / 2.0 + (b - a) / 2.0 * t for _, a, b in pending for t in _kronrod_nodes]
+        values = evaluate(points)
+        for n, (i, a, b) in enumerate(pending):
+            piece = values[15 * n:15 * n + 15]
+            kronrod = (b - a) / 2.0 * sum(w * v for w, v in zip(_kronrod_weights, piece))
+            gauss = (b - a) / 2.0 * sum(w * v for w, v in zip(_gauss_weights, piece))
+            heapq.heappush(pieces[i], (-abs(kronrod - gauss), a, b, kronrod))
+        pending = []
+        for i, heap in enumerate(pieces):
+            total = math.fsum(p[3] for p in heap)
+            error = -math.fsum(p[0] for p in heap)
+            if not error > tolerance * max(1.0, abs(total)):
+                continue
+            if len(heap) >= limit:
+                raise errors.QuadratureLimitException(
+                    'no convergence in %d pieces: %r with error estimate %r' % (limit, total, error))
+            count = len(heap)
+            while error > tolerance * max(1.0, abs(total)) and count < limit:
+                worst, a, b, kronrod = heapq.heappop(heap)
+                total -= kronrod
+                error += worst
+                count += 1
+                pending.extend([(i, a, (a + b) / 2.0), (i, (a + b) / 2.0, b)])
+    return [math.fsum(p[3] for p in heap) for heap in pieces]
+
+
+def _slope(function, var):
+    'Derivative by var of function if it is linear in var (a * var + b), else None'
+    if function == var:
+        return Fconst(1)
+    slope = function.derivative(var)
+    if slope.depends_on(var):
+        return None
+    return slope if slope.free_vars() else create_const(slope())
+
+
+def _ln_of(function):
+    'ln of function, a number for a constant; None for constants that are no base of a power or log'
+    value = _const_value(function)
+    if value is None:
+        return Fln(function)
+    return math.log(value) if value > 0 and value != 1 else None
+
+
+def _power_rule(node, var, integrals):
+    slope = _slope(node.f, var)
+    if slope is None:
+        return None
+    power = _const_value(node.power)
+    if power == -1:
+        return Fln(node.f) / slope
+    power = node.power + 1 if power is None else create_const(power + 1)
+    return node.f ** power / power / slope
+
+
+def _exponent_rule(node, var, integrals):
+    slope = _slope(node.power, var)
+    ln = _ln_of(node.f)
+    return None if slope is None or ln is None else node / ln / slope
+
+
+def _reciprocal_rule(node, var, integrals):
+    slope = _slope(node.denominator, var)
+    return None if slope is None else node.numerator * Fln(node.denominator) / slope
+
+
+def _sin_rule(node, var, integrals):
+    slope = _slope(node.arg, var)
+    return None if slope is None else -Fcos(node.arg) / slope
+
+
+def _cos_rule(node, var, integrals):
+    slope = _slope(node.arg, var)
+    return None if slope is None else Fsin(node.arg) / slope
+
+
+def _ln_rule(node, var, integrals):
+    slope = _slope(node.arg, var)
+    return None if slope is None else (node.arg * node - node.arg) / slope
+
+
+def _log_rule(node, var, integrals):
+    slope = _slope(node.arg, var)
+    ln = _ln_of(node.base)
+    if slope is None or ln is None:
+        return None
+    return (node.arg * node - node.arg / ln) / slope
+
+
+def _constant_integrals(node, var, integrals):
+    return [i * var if j is None else j for i, j in zip(node._children(), integrals)]
+
+
+def _sum_rule(node, var, integrals):
+    integrals = _constant_integrals(node, var, integrals)
+    return integrals[0] + integrals[1]
+
+
+def _difference_rule(node, var, integrals):
+    integrals = _constant_integrals(node, var, integrals)
+    return integrals[0] - integrals[1]
+
+
+def _negation_rule(node, var, integrals):
+    return -integrals[0]
+
+
+def _left_factor_rule(node, var, integrals):
+    return node.left * integrals[1]
+
+
+def _right_factor_rule(node, var, integrals):
+    return integrals[0] * node.right
+
+
+def _divisor_rule(node, var, integrals):
+    return integrals[0] / node.denominator
+
+
+def _rule_table(*entries):
+    'Rules keyed by (class, shape), from (class, shapes, rule) entries'
+    table = {}
+    for cls, shapes, rule in entries:
+        for shape in shapes:
+            table[cls, shape] = rule
+    return table
+
+
+_pairs = (('c', 'x'), ('c', 'f'), ('x', 'c'), ('x', 'x'), ('x', 'f'), ('f', 'c'), ('f', 'x'), ('f', 'f'))
+_linear_rules = _rule_table(
+    (Fsum, _pairs, _sum_rule),
+    (Fsub, _pairs, _difference_rule),
+    (Funminus, (('x',), ('f',)), _negation_rule),
+    (Fmult, (('c', 'x'), ('c', 'f')), _left_factor_rule),
+    (Fmult, (('x', 'c'), ('f', 'c')), _right_factor_rule),
+    (Fdiv, (('x', 'c'), ('f', 'c')), _divisor_rule))
+_linear_classes = frozenset(i[0] for i in _linear_rules)
+_antiderivative_rules = _rule_table(
+    (Fvar, ((),), lambda node, var, integrals: node ** 2 / 2),
+    (Fdiv, (('c', 'x'), ('c', 'f')), _reciprocal_rule),
+    (Fpower, (('x', 'c'), ('f', 'c')), _power_rule),
+    (Fpower, (('c', 'x'), ('c', 'f')), _exponent_rule),
+    (Fsin, (('x',), ('f',)), _sin_rule),
+    (Fcos, (('x',), ('f',)), _cos_rule),
+    (Fln, (('x',), ('f',)), _ln_rule),
+    (Flog, (('c', 'x'), ('c', 'f')), _log_rule))
+_antiderivative_rules.update(_linear_rules)
+
+
+_worker_compiled = None
+
+
+def _init_worker(tape, vars):
+    'Pool initializer: every worker receives the expression once, as a Tape'
+    global _worker_compiled
+    _worker_compiled = tape.thaw().compile(vars)
+
+
+def _evaluate_chunk(chunk):
+    return [_worker_compiled(*i) for i in chunk]
+
+
+def _compile(function, vars):
+    'Generates straight-line code: one assignment per distinct node object'
+    return _compile_nodes(function.plan().nodes, function, vars, '<function>')
+
+
+def _merged_nodes(functions):
+    'Distinct nodes of several functions, children before parents, shared subtrees once'
+    seen = set()
+    nodes = []
+    for function in functions:
+        for node in function.plan().nodes:
+            if id(node) not in seen:
+                seen.add(id(node))
+                nodes.append(node)
+    return nodes
+
+
+def _compile_nodes(nodes, outputs, vars, filename, namespace=None, result='%s'):
+    'Straight-line code over nodes (children first) returning an output function, or a list of outputs'
+    names = {}
+    args = {}
+    lines = []
+    for node in nodes:
+        if node.__class__ == Fvar:
+            if node.var not in args:
+                if vars is not None and node.var not in vars:
+                    raise ValueError("var %s is not in vars" % node.var)
+                args[node.var] = 'a%d' % len(args)
+            names[id(node)] = args[node.var]
+        elif node.__class__ == Fconst:
+            if node.c != node.c or node.c in (float('inf'), float('-inf')):
+                names[id(node)] = "float('%r')" % node.c
+            else:
+                names[id(node)] = '(%r)' % node.c if node.c < 0 else repr(node.c)
+        else:
+            names[id(node)] = 't%d' % len(lines)
+            lines.append('    %s = %s' % (names[id(node)], node._emit(tuple(names[id(i)] for i in node._children()))))
+    if vars is None:
+        vars = sorted(args)
+    if isinstance(outputs, Function):
+        returned = names[id(outputs)]
+    else:
+        returned = '[%s]' % ', '.join(names[id(i)] for i in outputs)
+    header = ', '.join(args.get(i, '_%d' % n) for n, i in enumerate(vars))
+    source = '\n'.join(['def compiled(%s):' % header] + lines + ['    return ' + result % returned])
+    return _exec_compiled(source, vars, filename, namespace)
+
+
+def _exec_compiled(source, vars, filename, namespace=None):
+    namespace = dict(namespace or {}, sin=math.sin, cos=math.cos, log=math.log)
+    exec(compile(source, filename, 'exec'), namespace)
+    compiled = namespace['compiled']
+    compiled.source = source
+    compiled.vars = tuple(vars)
+    return compiled
@@ -1,7 +1,22 @@
+import copy
+import gc
+import itertools
+import math
+import os
+import pickle
+import shutil
+import StringIO
+import tempfile
 import unittest
+import weakref
 from function import *
 import errors
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class TestDer(unittest.TestCase):
 
@@ -44,6 +59,40 @@ class TestDer(unittest.TestCase):
         self.assertEqual(
             x ** 3 / 3 - 2 * (x ** 2 / 2) + 5 * x, f.antiderivative())
 
+    def test_integrate(self):
+        x, y = self.x, self.y
+        self.assertEqual((x ** 2 - 2 * x + 5).integrate('x', 0, 3), 15)
+        self.assertAlmostEqual((x / 2).integrate('x', 0, 2), 1)
+        self.assertAlmostEqual((-y).integrate(y, 0, 2), -2)
+        self.assertAlmostEqual(ln(x).integrate('x', 0, 1), -1)
+        si = (sin(x) / x).integrate_many([(1, 2), (1, 10), (2, 2), (2, 1)])
+        for value, expected in zip(si, [0.659329906435512, 0.712264523851691, 0, -0.659329906435512]):
+            self.assertAlmostEqual(value, expected, 9)
+        f = sin(x * y) / (1 + x ** 2)
+        self.assertAlmostEqual(f.integrate('x', -1, 1, {'y': 3}), 0)
+        self.assertRaises(ValueError, f.integrate, 'x', 0, 1)
+        self.assertAlmostEqual(sin(1 / x).integrate('x', 0, 1, tolerance=1e-5), 0.504067061906928, 4)
+        self.assertRaises(errors.QuadratureLimitException, sin(1 / x).integrate, 'x', 0, 1)
+        self.assertRaises(errors.QuadratureLimitException, (1 / x).integrate, 'x', 0, 1)
+
+    def test_antider_rules(self):
+        x, y = self.x, self.y
+        self.assertEqual((-y).antiderivative(y), -(y ** 2 / 2))
+        self.assertEqual(sin(2 * x + 1).antiderivative(), -cos(2 * x + 1) / 2)
+        self.assertEqual((5 / x).antiderivative(), 5 * ln(x))
+        for f in [cos(x * y), ln(3 * x - 2), log(create_const(2), x + 1), 2 ** (3 * x), (2 * x + 1) ** 3,
+                  x ** -1, x ** y, (x + sin(x)) / 4 - y]:
+            self.assertAlmostEqual(f.antiderivative(x).derivative(x)(x=0.7, y=1.3), f(x=0.7, y=1.3))
+        self.assertRaises(errors.CantFindAntiDerivativeException, (x * sin(x)).antiderivative)
+        for f in [Fpower(create_const(1), x), Fpower(create_const(-2), x), log(create_const(1), x)]:
+            self.assertRaises(errors.CantFindAntiDerivativeException, f.antiderivative)
+        f = create_const(0)
+        for i in range(1500):
+            f = f + cos(x * i + y) * i
+        hits = antiderivative_cache.hits
+        self.assertIs(f.antiderivative(), f.antiderivative())
+        self.assertGreater(antiderivative_cache.hits, hits)
+
     def test_get_multipliers(self):
         x = self.x
         y = self.y
@@ -65,6 +114,346 @@ class TestDer(unittest.TestCase):
         y = self.y
         self.assertEqual((x + 6 * 9 * y - 5 + x).simplify_sum(), 54 * y + 2 * x - 5)
 
+    def test_simplify_wide(self):
+        x, y = self.x, self.y
+        f, g = create_const(0), create_const(1)
+        for i in range(2000):
+            f = f + (i % 7 + 1) * sin(x * (i % 1000)) * y - 3
+            g = g * x ** (i % 5) / cos(y + i % 1000)
+        summands = f.get_summands()
+        self.assertEqual((len(summands), summands[create_const(1)]), (1001, -6000))
+        self.assertAlmostEqual(f.simplify_sum()(x=0.7, y=1.3), f(x=0.7, y=1.3))
+        self.assertEqual(g.get_multipliers()['up'], {x: 4000, create_const(1): 1})
+        self.assertEqual(set(g.get_multipliers()['down'].values()), set([2]))
+        self.assertEqual(g.simplify_mult().get_multipliers()['up'], {x: 4000})
+        self.assertEqual((x ** y * 2 + x ** y).simplify_sum(), 3 * x ** y)
+
+    def test_compile(self):
+        f = create_function(
+            lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x))
+        g = f.derivative('x')
+        compiled = g.compile(['x', 'y'])
+        self.assertAlmostEqual(compiled(1.3, 2.1), g(x=1.3, y=2.1))
+        self.assertAlmostEqual(f.compile(['y', 'x'])(2.1, 1.3), f(x=1.3, y=2.1))
+        self.assertIs(g.compile(['x', 'y']), compiled)
+        self.assertRaises(ValueError, f.compile, ['x'])
+        x = self.x
+        self.assertEqual((x + float('inf')).compile()(1), float('inf'))
+        self.assertEqual((x - float('inf')).compile()(1), float('-inf'))
+        self.assertTrue(math.isnan((x * float('nan')).compile()(1)))
+        h = x ** 7 + sin(x) * 11
+        h.compile()
+        self.assertIsNone(getattr(h, '_repr', None))
+
+    def test_interning(self):
+        x = self.x
+        f = create_function(lambda x: (x ** 2 + cos(x)) ** 0.5)
+        self.assertIs(f, (x ** 2 + cos(x)) ** 0.5)
+        self.assertIs(f.derivative(), self.fs[2][0].derivative(x))
+        self.assertIs(copy.deepcopy(f), f)
+        self.assertNotEqual(x ** 2, x ** 3)
+        self.assertEqual(create_const(2), create_const(2.0))
+        self.assertIsNot(x + 2, x + 2.0)
+        self.assertEqual(x + 2, x + 2.0)
+        self.assertEqual((x ** 2).derivative(), (x ** 2.0).derivative())
+        self.assertNotEqual(x + 2, x + 2.5)
+
+    def test_gradient(self):
+        f = create_function(
+            lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x) + (x ** 2 + cos(y)) ** x / (1 + y))
+        point = {'x': 1.3, 'y': 2.1}
+        expected = [f.derivative('x')(**point), f.derivative('y')(**point)]
+        gradient = f.gradient(['x', 'y', 'z'])
+        self.assertEqual(gradient[2], 0)
+        for i in range(2):
+            self.assertAlmostEqual(gradient[i](**point), expected[i])
+        value, numeric = f.value_and_grad(point)
+        self.assertAlmostEqual(value, f(**point))
+        for i in range(2):
+            self.assertAlmostEqual(numeric[i], expected[i])
+        x, y = self.x, self.y
+        self.assertEqual((x ** -2).value_and_grad({'x': -1.0}), (1.0, [2.0]))
+        self.assertEqual((x ** -2).gradient(['x'])[0](x=-1.0), 2.0)
+        self.assertEqual((x ** y).value_and_grad({'x': -2.0, 'y': 2.0}, ['x']), (4.0, [-4.0]))
+
+    def test_forward(self):
+        f = create_function(
+            lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x) + (x ** 2 + cos(y)) ** x / (1 + y))
+        point = {'x': 1.3, 'y': 2.1}
+        value, derivative = f.forward(point, {'x': 1})
+        self.assertAlmostEqual(value, f(**point))
+        self.assertAlmostEqual(derivative, f.derivative('x')(**point))
+        value, partials = f.forward(point, {'x': [1, 0], 'y': [0, 1]})
+        for i, j in zip(partials, f.value_and_grad(point)[1]):
+            self.assertAlmostEqual(i, j)
+        self.assertEqual(f.forward(point, {'z': 1})[1], 0)
+        self.assertRaises(ValueError, f.forward, point, {'x': [1], 'y': [0, 1]})
+        x, y = self.x, self.y
+        self.assertEqual((x ** -2).forward({'x': -1.0}, {'x': 1}), (1.0, 2.0))
+        value, partials = (x ** y).forward({'x': -2.0, 'y': 2.0}, {'x': [1, 0], 'y': [0, 1]})
+        self.assertEqual((value, partials[0]), (4.0, -4.0))
+        self.assertTrue(math.isnan(partials[1]))
+
+    def test_taylor(self):
+        f = create_function(
+            lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x) + (x ** 2 + cos(y)) ** x / (1 + y) - x ** 0.5)
+        coefficients = f.taylor('x', 1.3, 4, {'y': 2.1})
+        self.assertAlmostEqual(coefficients[0], f(x=1.3, y=2.1))
+        for k in range(1, 5):
+            expected = f.derivative(['x'] * k)(x=1.3, y=2.1) / math.factorial(k)
+            self.assertAlmostEqual(coefficients[k], expected)
+        self.assertEqual((self.x ** 3).taylor('x', 0, 4), [0, 0, 0, 1, 0])
+        self.assertEqual(create_const(2).taylor('x', 1, 2), [2, 0, 0])
+
+    def test_jacobian(self):
+        x, y, z = self.x, self.y, self.z
+        J = jacobian([x * y + sin(z), x ** 2, 3])
+        self.assertEqual((J.shape, J.vars, len(J)), ((3, 3), ('x', 'y', 'z'), 4))
+        self.assertEqual(J.dense(), [[y, x, cos(z)], [2 * x, 0, 0], [0, 0, 0]])
+        rows, columns, values = J.compile(['z', 'y', 'x'])(0.5, 2, 3)
+        self.assertEqual((rows, columns), ((0, 0, 0, 1), (0, 1, 2, 0)))
+        self.assertEqual(values, [2, 3, math.cos(0.5), 6])
+
+    def test_hessian(self):
+        f = create_function(lambda x, y, z: x ** 3 * y + sin(z) + x * z)
+        H = hessian(f)
+        self.assertEqual(sorted(H.entries), [(0, 0), (0, 1), (0, 2), (1, 0), (2, 0), (2, 2)])
+        self.assertIs(H[0, 1], H[1, 0])
+        self.assertEqual(H[1, 2], 0)
+        rows, columns, values = H.compile()(1.5, 2, 0.5)
+        for i, j, value in zip(rows, columns, values):
+            expected = f.derivative([H.vars[i], H.vars[j]])(x=1.5, y=2, z=0.5)
+            self.assertAlmostEqual(value, expected)
+
+    def test_lazy_derivative(self):
+        f = create_function(
+            lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x) + (x ** 2 + cos(y)) ** x / (1 + y))
+        point = {'x': 1.3, 'y': 2.1}
+        g = f.derivative('x', lazy=True)
+        self.assertIsNone(getattr(g, '_expansion', None))
+        self.assertTrue(g.depends_on('y'))
+        self.assertEqual(f.derivative('z', lazy=True), 0)
+        self.assertTrue(repr(g).startswith('d/dx(x ** 5 + '))
+        h = g.derivative('y', lazy=True)
+        self.assertAlmostEqual(h(**point), f.derivative(['x', 'y'])(**point))
+        self.assertAlmostEqual(g.derivative('x')(**point), f.derivative(['x', 'x'])(**point))
+        self.assertAlmostEqual(g.freeze().thaw()(**point), f.derivative('x')(**point))
+        self.assertIs(pickle.loads(pickle.dumps(g, 2)), g)
+        self.assertRaises(ValueError, f.derivative, 'x', True, True)
+        x, y = self.x, self.y
+        self.assertFalse((x * x + y).derivative('x', lazy=True).depends_on('y'))
+        self.assertTrue((x * x + y).derivative('x', lazy=True).derivative('y', lazy=True).is_zero())
+        self.assertEqual((x + y).derivative('x', lazy=True).antiderivative('y')(y=3), 3)
+
+    def test_derivative_cache(self):
+        f = self.fs[2][0]
+        cache = DerivativeCache(maxsize=3)
+        cache.put(f, self.x, self.fs[2][1])
+        self.assertIs(cache.get(f, self.x), self.fs[2][1])
+        self.assertIs(cache.get(f, self.y), None)
+        powers = [var('w') ** i for i in range(5)]
+        for i in range(5):
+            cache.put(powers[i], self.x, Fconst(i))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 3, 'maxsize': 3})
+        del powers
+        self.assertEqual(cache.stats()['size'], 0)
+        hits = derivative_cache.hits
+        f.derivative(['x', 'x'])
+        self.assertGreater(derivative_cache.hits, hits)
+        g = create_function(lambda x, y: x ** y * sin(x * y) + ln(y) / x)
+        dropped = weakref.ref(g.derivative('x'))
+        del g
+        gc.collect()
+        self.assertIsNone(dropped())
+
+    def test_disk_cache(self):
+        f = create_function(lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x))
+        self.assertEqual(f.digest(), create_function(lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x)).digest())
+        self.assertNotEqual(f.digest(), f.derivative('x').digest())
+        directory = tempfile.mkdtemp()
+        try:
+            cache = DiskCache(directory)
+            g = cache.derivative(f, ['x', 'y'], simplify=True)
+            cache.compile(g, ['x', 'y'])
+            cache = DiskCache(directory)
+            self.assertIs(cache.derivative(f, ['x', 'y'], simplify=True), g)
+            self.assertIs(cache.simplified(g), g.simplify_sum())
+            compiled = cache.compile(g.derivative('x'), ['y', 'x'])
+            self.assertAlmostEqual(compiled(2.1, 1.3), g.derivative('x')(x=1.3, y=2.1))
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            cache = DiskCache(directory, maxbytes=500)
+            cache.simplified(f)
+            self.assertLessEqual(cache.stats()['bytes'], 500)
+            self.assertEqual(cache.stats()['bytes'], sum(os.path.getsize(os.path.join(directory, i)) for i in os.listdir(directory)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_free_vars(self):
+        f = create_function(
+            lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x))
+        self.assertEqual(f.free_vars(), frozenset(['x', 'y']))
+        self.assertEqual(create_const(3).free_vars(), frozenset())
+        self.assertTrue(f.depends_on(self.y))
+        self.assertFalse(f.depends_on('z'))
+        self.assertRaises(ValueError, f.depends_on, 1)
+        g = create_const(0)
+        for i in range(1, 4000):
+            g = g + sin(self.x * i) * self.y
+            self.assertTrue(g.depends_on('x'))
+        self.assertEqual(g.free_vars(), frozenset(['x', 'y']))
+
+    def test_deep_expression(self):
+        x, y = self.x, self.y
+        f = create_const(0)
+        for i in range(3000):
+            f = f + sin(x * i) * y
+        self.assertAlmostEqual(f(x=0.3, y=2), 2 * sum(math.sin(0.3 * i) for i in range(3000)))
+        self.assertAlmostEqual(f.derivative('y')(x=0.3, y=2), f(x=0.3, y=1))
+        self.assertTrue(repr(f).endswith(' + sin(x * 2999) * y'))
+        self.assertNotEqual(f, f.derivative('y'))
+
+    def test_render(self):
+        f = create_function(
+            lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x) - (2.5 - x) / -cos(x))
+        expected = 'x ** 5 + y * sin(x * y) + log[y](7 / x) - (2.5 - x) / (-cos(x))'
+        stream = StringIO.StringIO()
+        f.render(stream, buffer=3)
+        self.assertEqual(stream.getvalue(), expected)
+        self.assertEqual(repr(f), expected)
+        self.assertIs(repr(f), repr(f))
+        self.assertEqual(repr(f * 2), '(' + expected + ') * 2')
+
+    def test_tape(self):
+        f = create_function(
+            lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x) - 2.5)
+        tape = pickle.loads(pickle.dumps(f.derivative('x').freeze(), 2))
+        self.assertEqual(len(tape), 21)
+        self.assertIs(tape.thaw(), f.derivative('x'))
+        self.assertFalse(hasattr(f, '__dict__'))
+
+    def test_plan(self):
+        x = self.x
+        f, g = self.fs[2]
+        plan = g.plan()
+        self.assertIs(f.derivative(x).plan(), plan)
+        self.assertEqual((plan.tree_size, len(plan.nodes), plan.deduplicated), (19, 14, 5))
+        self.assertEqual(plan.nodes[-1], g)
+        self.assertEqual(g.compile().source.count(' = '), 11)
+        h = (x ** 2 + cos(x)) ** (-0.5)
+        self.assertAlmostEqual(g(x=0.7), 0.5 * h(x=0.7) * (1.4 - math.sin(0.7)))
+
+    def test_simplified_derivative(self):
+        x = self.x
+        self.assertEqual((5 * x ** 2 + 3 * x + 4).derivative(['x', 'x'], simplify=True), 10)
+        f = x ** 3 / (1 + x ** 2)
+        plain, simplified = f.derivative(['x'] * 4), f.derivative(['x'] * 4, simplify=True)
+        self.assertLess(simplified.plan().tree_size, plain.plan().tree_size)
+        self.assertAlmostEqual(simplified(x=0.7), plain(x=0.7))
+        self.assertEqual((x ** 0.5 * x).simplify_mult(), x ** 1.5)
+        f = create_const(0)
+        for i in range(1, 1000):
+            f = f + sin(x * i) * self.y + x
+        self.assertEqual(f.derivative('y', simplify=True), f.derivative('y').simplify_sum())
+        self.assertAlmostEqual(f.derivative('x', simplify=True)(x=0.3, y=2), f.derivative('x')(x=0.3, y=2))
+
+    def test_instrumentation(self):
+        f = self.fs[2][0]
+        self.assertEqual((f.size(), f.depth()), (8, 4))
+        self.assertEqual(f.node_counts(), {'Fpower': 2, 'Fsum': 1, 'Fvar': 1, 'Fconst': 2, 'Fcos': 1})
+        derivative_cache.clear()
+        with profile() as p:
+            f.derivative('x')(x=0.5)
+        self.assertEqual(p.counts[('Fpower', '_der')], 2)
+        self.assertEqual(p.counts[('Fmult', '__call__')], 1)
+        self.assertEqual(p.hot_nodes(1)[0][1], '_der')
+        self.assertNotIn('__call__', Fmult.__dict__)
+
+    def test_evaluate_many(self):
+        f = create_function(lambda x, y: x ** 5 + y * sin(x * y))
+        points = [(i * 0.1, 1 - i * 0.1) for i in range(25)]
+        expected = [f(x=i[0], y=i[1]) for i in points]
+        self.assertEqual(f.evaluate_many(points, workers=2, chunksize=4), expected)
+        self.assertEqual(f.evaluate_many([{'x': 1, 'y': 2}], workers=1), [f(x=1, y=2)])
+        self.assertEqual(f.evaluate_many(points, workers=1, vars=['y', 'x']),
+                         [f(x=i[1], y=i[0]) for i in points])
+
+    def test_evaluate_stream(self):
+        f = create_function(lambda x, y: x ** 5 + y * sin(x * y))
+        endless = ({'x': i * 0.01, 'y': 2} for i in itertools.count())
+        values = list(itertools.islice(f.evaluate_stream(endless, chunksize=3), 7))
+        self.assertEqual(values, [f(x=i * 0.01, y=2) for i in range(7)])
+        self.assertEqual(list(f.evaluate_stream([(2, 1)], vars=['y', 'x'])), [f(x=1, y=2)])
+
+    def test_subs(self):
+        x, y = self.x, self.y
+        f = create_function(lambda x, y, z: x ** 5 + y * sin(x * y) + log(y, 7 / x) * z + ln(z + y))
+        g = f.subs(y=2.5, z='t')
+        self.assertEqual(g.free_vars(), frozenset(['x', 't']))
+        self.assertAlmostEqual(g(x=1.3, t=0.7), f(x=1.3, y=2.5, z=0.7))
+        self.assertEqual(f.subs(x=2, y=3, z=1), f(x=2, y=3, z=1))
+        self.assertEqual((x * y + 3).subs(y=0), 3)
+        self.assertIs((x ** y).subs(y=1), x)
+        self.assertIs((x + 1).subs(x=2 * y), 2 * y + 1)
+        self.assertIs(f.subs(), f)
+
+    def test_function_bank(self):
+        f = create_function(lambda x, y: x ** 5 + y * sin(x * y))
+        g = create_function(lambda x, y: sin(x * y) * cos(x))
+        functions = [f, g, f.derivative('x'), create_const(3), g]
+        bank = FunctionBank(functions)
+        point = {'x': 1.3, 'y': 2.1}
+        expected = [i(**point) for i in functions]
+        self.assertEqual(bank(**point), expected)
+        self.assertEqual(bank.compile(['y', 'x'])(2.1, 1.3), expected)
+        self.assertEqual(bank.vars, ('x', 'y'))
+        stats = bank.stats()
+        self.assertEqual((stats['functions'], stats['nodes']), (5, len(bank.nodes)))
+        self.assertGreater(stats['shared'], len(g.plan().nodes))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_function_bank_array(self):
+        f = create_function(lambda x, y: x ** 5 + y * sin(x * y))
+        bank = FunctionBank([f, f.derivative('x'), sin(self.x * self.y)])
+        xs = numpy.linspace(0.5, 2, 5)
+        for function, values in zip(bank.functions, bank.evaluate_array(x=xs, y=1.5)):
+            for x, value in zip(xs, values):
+                self.assertAlmostEqual(value, function(x=x, y=1.5))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_evaluate_stream_vectorized(self):
+        f = create_function(lambda x, y: x ** 5 + y * sin(x * y))
+        points = [(i * 0.1, 2) for i in range(10)]
+        values = list(f.evaluate_stream(iter(points), chunksize=4, vectorized=True))
+        for value, point in zip(values, points):
+            self.assertAlmostEqual(value, f(x=point[0], y=point[1]))
+        self.assertEqual(len(values), 10)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_evaluate_array(self):
+        f = create_function(
+            lambda x, y: x ** 5 + y * sin(x * y) + log(y, 7 / x) + 3 / x)
+        g = f.derivative('x')
+        xs, ys = numpy.linspace(0.5, 2, 7), numpy.array([[1.5], [2.5]])
+        out = numpy.empty((2, 7))
+        self.assertIs(g.evaluate_array(out=out, x=xs, y=ys), out)
+        for i in range(2):
+            for j in range(7):
+                self.assertAlmostEqual(out[i, j], g(x=xs[j], y=ys[i, 0]))
+        self.assertEqual(list((1 / self.x).evaluate_array(x=numpy.array([2, 4]))), [0.5, 0.25])
+        x, xs = self.x, numpy.array([1.0, 2.0])
+        self.assertEqual(list((x + create_const(10) ** 20).evaluate_array(x=xs)), [1e20 + 1, 1e20 + 2])
+        self.assertEqual(list((x * create_const(2) ** -1).evaluate_array(x=xs)), [0.5, 1.0])
+        out = numpy.zeros(2)
+        self.assertIs(x.evaluate_array(out=out, x=xs), out)
+        self.assertEqual(list(out), [1.0, 2.0])
+        self.assertIs(create_const(3).evaluate_array(out=out), out)
+        self.assertEqual(list(out), [3.0, 3.0])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_integrate_scalar_integrand(self):
+        with numpy.errstate(invalid='ignore'):
+            self.assertTrue(math.isnan(ln(self.y).integrate('x', 0, 1, {'y': -1.0})))
+
 
 if __name__ == '__main__':
     unittest.main()